@@ -0,0 +1,120 @@
+from rdflib import URIRef
+from array import array
+import tempfile
+import pickle
+import os
+
+
+class SuperEdgeIndex:
+    """
+    Prototype-to-prototype super-edges of a graph in compressed sparse row form. Cluster URIs and
+    predicates are dictionary encoded; for every cluster id, offsets[id]:offsets[id+1] is the slice of
+    its edges in the neighbour, predicate and count arrays, once by subject and once by object.
+    """
+    def __init__(self, uris, predicates, forward, backward):
+        self.uris = uris
+        self.predicates = predicates
+        self.forward_csr = forward
+        self.backward_csr = backward
+        self.ids = {uri: i for i, uri in enumerate(uris)}
+
+    @classmethod
+    def build(cls, edges):
+        ids = {}
+        pred_ids = {}
+        encoded = []
+        for s, p, o, cnt in edges:
+            s = ids.setdefault(str(s), len(ids))
+            o = ids.setdefault(str(o), len(ids))
+            p = pred_ids.setdefault(str(p), len(pred_ids))
+            encoded.append((s, p, o, cnt))
+        uris = [None] * len(ids)
+        for uri, i in ids.items():
+            uris[i] = uri
+        predicates = [None] * len(pred_ids)
+        for pred, i in pred_ids.items():
+            predicates[i] = pred
+        forward = cls._csr(len(uris), ((s, p, o, cnt) for s, p, o, cnt in encoded))
+        backward = cls._csr(len(uris), ((o, p, s, cnt) for s, p, o, cnt in encoded))
+        return cls(uris, predicates, forward, backward)
+
+    @staticmethod
+    def _csr(n, edges):
+        edges = sorted(edges)
+        offsets = array('l', [0] * (n + 1))
+        neighbours = array('i')
+        preds = array('i')
+        counts = array('l')
+        for node, p, other, cnt in edges:
+            offsets[node + 1] += 1
+            neighbours.append(other)
+            preds.append(p)
+            counts.append(cnt)
+        for i in range(n):
+            offsets[i + 1] += offsets[i]
+        return offsets, neighbours, preds, counts
+
+    def _edges(self, csr, uri):
+        i = self.ids.get(str(uri))
+        if i is None:
+            return
+        offsets, neighbours, preds, counts = csr
+        for j in range(offsets[i], offsets[i + 1]):
+            yield URIRef(self.predicates[preds[j]]), URIRef(self.uris[neighbours[j]]), counts[j]
+
+    def forward(self, uri):
+        """ (predicate, object cluster, count) of the super-edges leaving `uri` """
+        return self._edges(self.forward_csr, uri)
+
+    def backward(self, uri):
+        """ (predicate, subject cluster, count) of the super-edges entering `uri` """
+        return self._edges(self.backward_csr, uri)
+
+    def edges(self, uris):
+        """ (subject, predicate, object, count) of the super-edges touching any of `uris` """
+        for uri in uris:
+            uri = URIRef(uri)
+            for p, o, cnt in self.forward(uri):
+                yield uri, p, o, cnt
+            for p, s, cnt in self.backward(uri):
+                yield s, p, uri, cnt
+
+    def save(self, file_path):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((self.uris, self.predicates, self.forward_csr, self.backward_csr), f,
+                            pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, file_path):
+        with open(file_path, 'rb') as f:
+            return cls(*pickle.load(f))
+
+
+def run(sparql, graph, file_path, namespaces):
+    open_clause = close_clause = ''
+    if graph:
+        open_clause = 'GRAPH <%s> {' % graph
+        close_clause = '}'
+
+    query = """
+    SELECT ?s ?p ?o ?cnt
+    WHERE {
+        %s
+            ?s aida:prototype ?proto1 .
+            ?o aida:prototype ?proto2 .
+            ?se rdf:subject ?proto1 ;
+                rdf:predicate ?p ;
+                rdf:object ?proto2 ;
+                aida:confidence/aida:confidenceValue ?conf .
+            BIND(ROUND(1/(2*(1-?conf))) as ?cnt)
+        %s
+    } """ % (open_clause, close_clause)
+
+    edges = ((s, p, o, int(float(str(cnt)))) for s, p, o, cnt in sparql.query_stream(query, namespaces))
+    SuperEdgeIndex.build(edges).save(file_path)
@@ -1,17 +1,19 @@
-import os
+import gzip
 from flask import Flask, render_template, abort, request, jsonify
 # from model import get_cluster, get_cluster_list, types, recover_doc_online
-from model import Model, types
+from model import Model, types, get_model
+from cluster_index import decode_cursor
+from graph import neighborhood_json
 # from setting import repo, port, repositories, upload_folder, import_endpoint
 import setting
 from setting import url_prefix
 import groundtruth as gt
 import debug
-import requests
-from rdflib.plugins.stores.sparqlstore import SPARQLStore
-import tmp
-import time_person_label
-import re
+import ingest
+import store
+import query_cache
+import prewarm
+import render
 
 
 app = Flask(__name__, static_folder='static')
@@ -19,23 +21,15 @@ app.jinja_env.globals.update(str=str)  # allow str function to be used in templa
 app.jinja_env.globals.update(round=round)  # allow round function to be used in template
 app.config['JSON_AS_ASCII'] = True
 
-
-def generate_pkl(sparql, graph, file_path):
-    tmp.run(sparql, graph, file_path)
-    time_person_label.run(sparql, graph, file_path)
+if setting.prewarm_on_startup:
+    prewarm.start()
 
 
 @app.route('/')
 def index():
     repos = {}
     for repo in setting.repositories:
-        repos[repo] = []
-        endpoint = setting.endpoint + '/' + repo + '/rdf-graphs'
-        res = requests.get(endpoint, headers={'Accept': 'application/sparql-results+json'},
-                           auth=(setting.username, setting.password))
-        result = res.json()['results']['bindings']
-        for r in result:
-            repos[repo].append(r['contextID']['value'])
+        repos[repo] = store.list_graphs(repo)
     return render_template('index.html',
                            url_prefix=url_prefix,
                            repos=repos)
@@ -44,8 +38,7 @@ def index():
 @app.route('/repo/<repo>')
 def hello_world(repo):
     graph_uri = request.args.get('g', '')
-    sparql = SPARQLStore(setting.endpoint + '/' + repo)
-    model = Model(sparql, repo, graph_uri)
+    model = get_model(repo, graph_uri)
     return render_template('clusters.html',
                            url_prefix=url_prefix,
                            repo=repo,
@@ -80,6 +73,30 @@ def show_viz(name):
     return render_template('sviz.html', url_prefix=url_prefix, name=name)
 
 
+@app.route('/render/<name>')
+def rendered_graph(name):
+    status = render.service.status(name)
+    rendered = render.service.get(name) if status == render.READY else None
+    if rendered:
+        key, data = rendered
+        if request.if_none_match.contains(key):
+            res = app.response_class(status=304)
+        elif request.accept_encodings['gzip']:
+            res = app.response_class(data, mimetype='image/svg+xml')
+            res.headers['Content-Encoding'] = 'gzip'
+        else:
+            res = app.response_class(gzip.decompress(data), mimetype='image/svg+xml')
+        # the image of a name changes with its graph, clients revalidate with the content hash
+        res.set_etag(key)
+        res.headers['Cache-Control'] = 'no-cache'
+        res.vary.add('Accept-Encoding')
+        return res
+    if status == render.READY:
+        status = render.MISSING
+    code = {render.PENDING: 202, render.FAILED: 500}.get(status, 404)
+    return jsonify({'name': name, 'status': status, 'error': render.service.error(name)}), code
+
+
 @app.route('/cluster/entities/<repo>/<uri>')
 @app.route('/entities/<repo>/<uri>')
 def show_entity_cluster(repo, uri):
@@ -90,8 +107,7 @@ def show_entity_cluster(repo, uri):
     graph_uri = request.args.get('g', default=None)
     show_image = request.args.get('image', default=True)
     show_limit = request.args.get('limit', default=100)
-    sparql = SPARQLStore(setting.endpoint + '/' + repo)
-    model = Model(sparql, repo, graph_uri)
+    model = get_model(repo, graph_uri)
     return show_cluster(model, uri, show_image, show_limit)
 
 
@@ -99,32 +115,28 @@ def show_entity_cluster(repo, uri):
 def show_entity_cluster_list(type_, repo):
     graph_uri = request.args.get('g', default=None)
     limit = request.args.get('limit', default=100, type=int)
-    offset = request.args.get('offset', default=0, type=int)
-    sortby = request.args.get('sortby', default='size')
-    sparql = SPARQLStore(setting.endpoint + '/' + repo)
-    model = Model(sparql, repo, graph_uri)
     if type_ == 'entity':
-        return render_template('list.html',
-                               url_prefix=url_prefix,
-                               type_='entity',
-                               repo=repo,
-                               graph=graph_uri,
-                               limit=limit,
-                               offset=offset,
-                               sortby=sortby,
-                               clusters=model.get_cluster_list(types.Entity, limit, offset, sortby))
+        class_ = types.Entity
     elif type_ == 'event':
-        return render_template('list.html',
-                               url_prefix=url_prefix,
-                               type_='event',
-                               repo=repo,
-                               graph=graph_uri,
-                               limit=limit,
-                               offset=offset,
-                               sortby=sortby,
-                               clusters=model.get_cluster_list(types.Events, limit, offset, sortby))
+        class_ = types.Events
     else:
         abort(404)
+    model = get_model(repo, graph_uri)
+    # the list may not support the requested order, its cursors and links are in the one it is given in
+    sortby = model.list_order(class_, request.args.get('sortby', default='size'))
+    after = decode_cursor(request.args.get('after'), sortby)
+    before = decode_cursor(request.args.get('before'), sortby)
+    page = model.get_cluster_page(class_, limit, after, before, sortby)
+    return render_template('list.html',
+                           url_prefix=url_prefix,
+                           type_=type_,
+                           repo=repo,
+                           graph=graph_uri,
+                           limit=limit,
+                           sortby=sortby,
+                           clusters=page.clusters,
+                           next=page.next,
+                           prev=page.prev)
 
 
 @app.route('/cluster/events/<repo>/<uri>')
@@ -134,8 +146,7 @@ def show_event_cluster(repo, uri):
     graph_uri = request.args.get('g', default=None)
     show_image = request.args.get('image', default=True)
     show_limit = request.args.get('limit', default=100)
-    sparql = SPARQLStore(setting.endpoint + '/' + repo)
-    model = Model(sparql, repo, graph_uri)
+    model = get_model(repo, graph_uri)
     return show_cluster(model, uri, show_image, show_limit)
 
 
@@ -145,8 +156,7 @@ def show_columbia_cluster(repo, uri):
     uri = 'http://www.columbia.edu/AIDA/' + uri
     show_image = request.args.get('image', default=True)
     show_limit = request.args.get('limit', default=100)
-    sparql = SPARQLStore(setting.endpoint + '/' + repo)
-    model = Model(sparql, repo, graph_uri)
+    model = get_model(repo, graph_uri)
     return show_cluster(model, uri, show_image, show_limit)
 
 
@@ -158,6 +168,7 @@ def show_cluster(model: Model, uri, show_image=True, show_limit=100):
     if not cluster:
         abort(404)
     print(cluster.href)
+    cluster.prefetch(show_image)
     return render_template('cluster.html',
                            url_prefix=url_prefix,
                            repo=model.repo,
@@ -183,8 +194,7 @@ def show_doc_pronoun(doc_id):
 def show_entity_gt(repo):
     uri = request.args.get('e', default=None)
     graph_uri = request.args.get('g', default=None)
-    sparql = SPARQLStore(setting.endpoint + '/' + repo)
-    model = Model(sparql, repo, graph_uri)
+    model = get_model(repo, graph_uri)
     cluster = model.get_cluster(uri)
     return render_template('groundtruth.html', url_prefix=url_prefix, repo=repo, graph=graph_uri, cluster=cluster)
 
@@ -198,30 +208,21 @@ def show_import_debugger():
 def import_clusters():
     repo = request.form['repo']
     graph_uri = request.form['graph_uri']
+    kind = request.form.get('kind', ingest.DEBUG)
     debug_file = request.files['debug_file']
 
-    if repo and debug_file:
-
-        # create directory for debug files if doesn't exist
-        data_dir = setting.debug_data
-        if not os.path.isdir(data_dir):
-            os.makedirs(data_dir)
+    if repo and debug_file and kind in {ingest.DEBUG, ingest.GROUNDTRUTH}:
 
-        if graph_uri:
-            filename = repo + '-' + re.sub('[^0-9a-zA-Z]+', '-', graph_uri)
-        else:
-            filename = repo
-
-        file = data_dir + '/' + filename + '.jl'
-
-        # upload file
-        debug_file.save(file)
+        # stream the upload to disk, validating and indexing happen in the background
+        upload = ingest.save_upload(debug_file.stream, debug_file.filename)
+        job = ingest.submit(kind, repo, graph_uri, upload)
 
         return '''
         <!doctype html>
-        <title>Imported</title>
-        <h1>Imported</h1>
-        '''
+        <title>Importing</title>
+        <h1>Importing</h1>
+        <p>Follow the progress at <a href="%s/import-status/%s">%s</a></p>
+        ''' % (url_prefix, job.id, job.id)
 
     else:
         return '''
@@ -230,6 +231,15 @@ def import_clusters():
         <h1>Invalid</h1>
         '''
 
+
+@app.route('/import-status/<job_id>', methods=['GET'])
+def import_status(job_id):
+    job = ingest.get_job(job_id)
+    if job:
+        return jsonify(job.to_json())
+    return not_found()
+
+
 @app.route('/groundtruth/<repo>', methods=['GET'])
 def groundtruth(repo):
     graph = request.args.get('g', default=None)
@@ -261,6 +271,46 @@ def debugger(repo):
         return not_found()
 
 
+@app.route('/graph/<repo>', methods=['GET'])
+def cluster_graph(repo):
+    graph_uri = request.args.get('g', default=None)
+    expand = request.args.get('expand')
+    cluster_uri = expand or request.args.get('cluster')
+    # an expansion adds the direct neighbours of one node to a graph the client already has
+    hop = 1 if expand else min(max(request.args.get('hop', default=1, type=int), 1), 3)
+    if not cluster_uri:
+        return not_found()
+    model = get_model(repo, graph_uri)
+    cluster = model.get_cluster(cluster_uri)
+    if not cluster:
+        return not_found()
+    return jsonify(neighborhood_json(model, cluster, hop))
+
+
+@app.route('/stats/sparql', methods=['GET'])
+def sparql_stats():
+    return jsonify(store.pool_stats())
+
+
+@app.route('/stats/cache', methods=['GET'])
+def cache_stats():
+    return jsonify(query_cache.cache.stats())
+
+
+@app.route('/cache/<repo>/invalidate', methods=['POST'])
+def invalidate_cache(repo):
+    graph = request.args.get('g', default=None)
+    query_cache.cache.invalidate(repo, graph)
+    return jsonify(query_cache.cache.stats())
+
+
+@app.route('/summary/<repo>/refresh', methods=['POST'])
+def refresh_summary(repo):
+    graph = request.args.get('g', default=None)
+    changed = get_model(repo, graph).refresh()
+    return jsonify({'changed': changed})
+
+
 @app.errorhandler(404)
 def not_found(error=None):
     message = {
@@ -0,0 +1,144 @@
+from rdflib.namespace import split_uri
+from collections import namedtuple, defaultdict
+from bisect import bisect_left, bisect_right
+import base64
+import json
+
+IndexEntry = namedtuple('IndexEntry', ['uri', 'label', 'count', 'category'])
+
+SIZE = 'size'
+TYPE = 'type'
+LABEL = 'label'
+
+
+def size_key(e):
+    return -e.count, e.uri
+
+
+def type_key(e):
+    return e.category, -e.count, e.uri
+
+
+def label_key(e):
+    return e.label, -e.count, e.uri
+
+
+sort_keys = {
+    SIZE: size_key,
+    TYPE: type_key,
+    LABEL: label_key,
+}
+
+
+def cursor_values(e, sortby=SIZE):
+    """
+    Position of an entry in a list as the values of its sort columns, e.g. [size, uri] or [type, size, uri].
+    """
+    if sortby == TYPE:
+        return [e.category, e.count, e.uri]
+    if sortby == LABEL:
+        return [e.label, e.count, e.uri]
+    return [e.count, e.uri]
+
+
+def to_sort_key(values):
+    values = list(values)
+    values[-2] = -values[-2]
+    return tuple(values)
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def valid_cursor(values, sortby=SIZE):
+    """
+    `values` if they are a position in a list sorted by `sortby`, otherwise None (the first page).
+    """
+    if sortby in (TYPE, LABEL):
+        types_ = (str, int, str)
+    else:
+        types_ = (int, str)
+    if not isinstance(values, list) or len(values) != len(types_):
+        return None
+    # bool is an int too, but never a count
+    if any(not isinstance(v, t) or isinstance(v, bool) for v, t in zip(values, types_)):
+        return None
+    return values
+
+
+def decode_cursor(cursor, sortby=SIZE):
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except ValueError:
+        return None
+    return valid_cursor(values, sortby)
+
+
+ClusterPage = namedtuple('ClusterPage', ['clusters', 'next', 'prev'])
+
+
+class ClusterIndex:
+    """
+    In-memory cluster lists built from a cluster summary, presorted per prototype class
+    by size, by type then size and by label then size.
+    """
+    def __init__(self, pickled, relation_class):
+        by_class = defaultdict(list)
+        # summaries written before clusters carried their prototype class can't be indexed
+        self.available = any('class' in c for c in pickled.values())
+        for uri, c in pickled.items():
+            if 'class' not in c or 'size' not in c:
+                continue
+            label = c.get('label', uri)
+            if c['class'] != relation_class and c.get('type', '').startswith('http'):
+                _, category = split_uri(c['type'])
+            else:
+                category = label
+            # summary sizes include the prototype's own membership, cluster lists do not
+            count = c['size'] - 1
+            if count > 0:
+                by_class[c['class']].append(IndexEntry(uri, label, count, category))
+
+        self.__orders = {}
+        self.__keys = {}
+        if self.available:
+            for class_, entries in by_class.items():
+                for sortby, key in sort_keys.items():
+                    entries = sorted(entries, key=key)
+                    self.__orders[(class_, sortby)] = entries
+                    self.__keys[(class_, sortby)] = [key(e) for e in entries]
+
+    def entries(self, class_, sortby=SIZE):
+        if sortby not in sort_keys:
+            sortby = SIZE
+        return self.__orders.get((str(class_), sortby), [])
+
+    def page(self, class_, limit=10, offset=0, sortby=SIZE):
+        entries = self.entries(class_, sortby)
+        if limit:
+            return entries[offset:offset + limit]
+        return entries[offset:]
+
+    def keyset_page(self, class_, limit=10, after=None, before=None, sortby=SIZE):
+        """
+        The `limit` entries right after (or right before) the cursor position, found by binary search.
+        """
+        if sortby not in sort_keys:
+            sortby = SIZE
+        after = valid_cursor(after, sortby)
+        before = valid_cursor(before, sortby)
+        entries = self.entries(class_, sortby)
+        keys = self.__keys.get((str(class_), sortby), [])
+        if before is not None:
+            end = bisect_left(keys, to_sort_key(before))
+            start = max(0, end - limit)
+        else:
+            start = bisect_right(keys, to_sort_key(after)) if after is not None else 0
+            end = start + limit
+        page = entries[start:end]
+        next_ = encode_cursor(cursor_values(page[-1], sortby)) if page and end < len(entries) else None
+        prev = encode_cursor(cursor_values(page[0], sortby)) if page and start > 0 else None
+        return ClusterPage(page, next_, prev)
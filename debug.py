@@ -1,40 +1,186 @@
-import json_lines
+from collections import OrderedDict
+import threading
+import time
+import keyfile
+import mmap
+import json
 import re
 import os
+import setting
 
-debugs = {}  # rep/graph to its raw debug data
-debugs_cache = {}
+debugs = {}  # rep/graph to its DebugStore
+debugs_lock = threading.Lock()
 
 
-def has_debug(repo, graph):
+def debug_id(repo, graph):
     did = repo
     if graph:
         did = repo + '-' + re.sub('[^0-9a-zA-Z]+', '-', graph)
+    return did
 
-    debug_file = 'debug/' + did + '.jl'
-    return os.path.isfile(debug_file)
 
+def debug_file(repo, graph):
+    return setting.debug_data + '/' + debug_id(repo, graph) + '.jl'
 
-def get_debug_for_cluster(repo, graph, cluster_uri):
 
-    did = repo
-    if graph:
-        did = repo + '-' + re.sub('[^0-9a-zA-Z]+', '-', graph)
+def index_file(data_file):
+    return data_file + '.idx'
 
-    # get debug file for repo/graph if hasn't been loaded
-    if did not in debugs:
-        debugs[did] = []
-        debug_file = 'debug/' + did + '.jl'
-        if os.path.isfile(debug_file):
-            with open(debug_file, 'r') as f:
-                for line in json_lines.reader(f):
-                    debugs[did].append(line)
-        else:
-            return None
 
-    entity_uri = cluster_uri.replace('-cluster', '')
-    for debug in debugs[did]:
-        if entity_uri in debug['all_records']:
-            return debug
-    return None  # not found
+def version_file(repo, graph):
+    # debug_file links to the current version once it has been ingested
+    return '%s/versions/%s.%d.jl' % (setting.debug_data, debug_id(repo, graph), time.time() * 1000)
+
+
+def publish(repo, graph, version):
+    """
+    Atomically points the debug file of repo/graph to an indexed version and removes the versions before
+    the previous one. Readers holding the previous version keep using it until they see the switch.
+    """
+    data_file = debug_file(repo, graph)
+    link = data_file + '.swap'
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.relpath(version, os.path.dirname(data_file)), link)
+    previous = os.path.realpath(data_file) if os.path.islink(data_file) else None
+    os.replace(link, data_file)
+
+    versions = os.path.dirname(version)
+    prefix = debug_id(repo, graph) + '.'
+    keep = {os.path.abspath(version), previous}
+    for name in os.listdir(versions):
+        path = os.path.abspath(os.path.join(versions, name))
+        if name.startswith(prefix) and name.endswith('.jl') and path not in keep:
+            for stale in (path, index_file(path)):
+                if os.path.isfile(stale):
+                    os.remove(stale)
+
+
+def has_debug(repo, graph):
+    return os.path.isfile(debug_file(repo, graph))
+
+
+def fingerprint(data_file):
+    stat = os.stat(data_file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def build_index(data_file, progress=None):
+    """
+    Writes the index of a debug file: every entity uri of a record's 'all_records' to the byte offset
+    of that record's line.
+    """
+    stamp = fingerprint(data_file)
 
+    def entries():
+        with open(data_file, 'rb') as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    for uri in json.loads(line)['all_records']:
+                        yield uri, str(offset)
+                offset += len(line)
+                if progress:
+                    progress(offset)
+
+    keyfile.write(index_file(data_file), entries(), {'data': stamp})
+
+
+def index_is_current(data_file):
+    idx = index_file(data_file)
+    if not os.path.isfile(idx):
+        return False
+    index = keyfile.KeyFile(idx)
+    try:
+        return index.meta.get('data') == fingerprint(data_file)
+    finally:
+        index.close()
+
+
+class DebugStore:
+    """
+    Debug records of one debug file, found through its index and parsed on demand.
+    The most recently used parsed records are kept.
+    """
+    def __init__(self, data_file, cache_size=256):
+        self.data_file = data_file
+        if not index_is_current(data_file):
+            build_index(data_file)
+        self.index = keyfile.KeyFile(index_file(data_file))
+        self.stamp = self.index.meta.get('data')
+        self.__file = open(data_file, 'rb')
+        self.__mm = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__records = OrderedDict()  # offset to parsed record
+        self.__cache_size = cache_size
+        self.__lock = threading.Lock()
+        self.closed = False
+
+    def get(self, entity_uri):
+        """
+        The record of `entity_uri`, None if there is none or the store was closed meanwhile.
+        """
+        # the mapped files are only read with the lock held, so close() never releases them under a reader
+        with self.__lock:
+            if self.closed:
+                return None
+            offset = self.index.get(entity_uri)
+            if offset is None:
+                return None
+            offset = int(offset)
+            record = self.__records.get(offset)
+            if record is not None:
+                self.__records.move_to_end(offset)
+                return record
+            end = self.__mm.find(b'\n', offset)
+            line = self.__mm[offset:end if end >= 0 else len(self.__mm)]
+        record = json.loads(line)
+        with self.__lock:
+            self.__records[offset] = record
+            while len(self.__records) > self.__cache_size:
+                self.__records.popitem(last=False)
+        return record
+
+    def close(self):
+        with self.__lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.__records.clear()
+            self.index.close()
+            self.__mm.close()
+            self.__file.close()
+
+
+def get_store(repo, graph):
+    did = debug_id(repo, graph)
+    data_file = os.path.realpath(debug_file(repo, graph))
+    if not os.path.isfile(data_file):
+        return None
+
+    def current(store):
+        return store is not None and store.data_file == data_file and store.stamp == fingerprint(data_file)
+
+    store = debugs.get(did)
+    if not current(store):
+        with debugs_lock:
+            store = debugs.get(did)
+            if not current(store):
+                previous = store
+                store = debugs[did] = DebugStore(data_file, setting.debug_cache_records)
+                # unmapping the old version lets its file be freed once it is unlinked
+                if previous is not None:
+                    previous.close()
+    return store
+
+
+def get_debug_for_cluster(repo, graph, cluster_uri):
+    entity_uri = cluster_uri.replace('-cluster', '')
+    # a store swapped for a new version while it was read is closed, the new one is read instead
+    for _ in range(2):
+        store = get_store(repo, graph)
+        if store is None:
+            return None
+        record = store.get(entity_uri)
+        if not store.closed:
+            return record
+    return None
@@ -1,13 +1,7 @@
 from rdflib.namespace import split_uri
 from typing import List
-from model import SuperEdge, AIDA
+from model import SuperEdge, Neighborhood, AIDA
 import uuid
-import subprocess
-import pickle
-
-SVG = 'SVG'
-PNG = 'PNG'
-# clusters = pickle.load(open('cluster.pkl', 'rb'))
 
 
 class Graph:
@@ -32,18 +26,6 @@ class Graph:
         edge_string = [x.to_draw() for x in self.edges]
         return self.generate(node_strings, edge_string)
 
-    def dot(self, format=SVG, path='static/img/'):
-        prefix = path + self.name
-        dotpath = prefix + '.dot'
-        with open(dotpath, 'w') as f:
-            f.write(self.to_draw())
-        imgpath = prefix+'.'+format.lower()
-        e = subprocess.call(
-            ['dot', '-T' + format.lower(), '-o', imgpath, dotpath, '-Ksfdp', '-Goverlap=prism', '-Goverlap_scaling=5',
-             '-Gsep=+20'])
-        print(e)
-        return imgpath
-
 
 class Element:
     def __init__(self, id_, config=None):
@@ -121,6 +103,10 @@ type_color_map = {
 class ClusterNode(Node):
     def __init__(self, uri, count, label=None, config=None, type_=None):
         super().__init__(uri, config)
+        self.uri = str(uri)
+        self.count = count
+        self.label = label
+        self.type = str(type_) if type_ else None
         if type_:
             self.set_color(type_)
         if label:
@@ -138,10 +124,22 @@ class ClusterNode(Node):
         words = label + " (×{})".format(count)
         return "\\n".join(self.text_justify(words, max_width))
 
+    def to_json(self):
+        return {
+            'uri': self.uri,
+            'label': str(self.label) if self.label else '',
+            'size': self.count,
+            'type': self.type,
+            'color': self.config.get('fillcolor'),
+        }
+
 
 class ClusterEdge(Edge):
     def __init__(self, sub, obj, pred, count, config=None):
         super().__init__(sub, obj, config)
+        self.sub = str(sub)
+        self.obj = str(obj)
+        self.count = count
         if pred and pred.startswith('http'):
             ind = pred.find('_')
             pred = pred[ind+1:]
@@ -156,6 +154,14 @@ class ClusterEdge(Edge):
         words = label + " (×{})".format(count)
         return "\\n".join(self.text_justify(words, max_width))
 
+    def to_json(self):
+        return {
+            'source': self.sub,
+            'target': self.obj,
+            'predicate': str(self.pred),
+            'count': self.count,
+        }
+
     def __hash__(self):
         return hash((self.id, self.pred))
 
@@ -169,6 +175,15 @@ class ClusterGraph(Graph):
         self.nodes = clusters
         self.edges = super_edges
 
+    def to_json(self):
+        """
+        Nodes and edges of the graph for layout in the browser, without going through DOT.
+        """
+        return {
+            'nodes': [n.to_json() for n in self.nodes],
+            'edges': [e.to_json() for e in self.edges],
+        }
+
 
 class SuperEdgeBasedGraph(ClusterGraph):
     def __init__(self, model, superedges: List[SuperEdge], base=None, name=None):
@@ -201,10 +216,14 @@ class SuperEdgeBasedGraph(ClusterGraph):
             return SuperEdgeBasedGraph._cluster_node_from_cluster(model.get_cluster(uri))
 
 
-
-# if __name__ == '__main__':
-#     cluster = get_cluster('http://www.isi.edu/gaia/entities/4242167c-60ee-4ea5-9efa-105d41ce8306-cluster')
-#     # cluster = get_cluster('http://www.isi.edu/gaia/assertions/bdc5d9d1-5167-4d93-b2c1-d0b3e62bf12c-cluster')
-#     neighborhood = cluster.neighborhood()
-#     graph = SuperEdgeBasedGraph(neighborhood, cluster, cluster.uri)
-#     dot_string = graph.dot()
+def neighborhood_json(model, cluster, hop=1):
+    """
+    JSON graph of the neighbourhood of `cluster`; with hop=1 it also serves to expand a single node of a graph
+    already shown.
+    """
+    neighborhood = Neighborhood(model)
+    graph = SuperEdgeBasedGraph(model, neighborhood.explore(cluster, hop), cluster, cluster.uri)
+    result = graph.to_json()
+    result['root'] = str(cluster.uri)
+    result['truncated'] = neighborhood.truncated
+    return result
@@ -1,38 +1,81 @@
 import json_lines
+import threading
 import os
 import re
 
-# a list of lists
+# gt id to its GroundtruthIndex
 groundtruth = {}
+groundtruth_lock = threading.Lock()
 prefix = 'http://www.isi.edu/gaia/entities/'
 
 
-def has_gt(repo, graph):
+def gt_file(repo, graph):
     gtid = repo
     if graph:
         gtid = gtid + repo + '-' + re.sub('[^0-9a-zA-Z]+', '-', graph)
-    file = 'gt/' + gtid + 'jl'
+    return gtid, 'gt/' + gtid + 'jl'
+
+
+class GroundtruthIndex:
+    """
+    Ground truth clusters of one repo/graph with an inverted index from member to its cluster.
+    """
+    def __init__(self, clusters, mtime=None):
+        self.clusters = clusters
+        self.mtime = mtime
+        self.cluster_of = {}
+        for i, cluster in enumerate(clusters):
+            for member in cluster:
+                self.cluster_of.setdefault(member, i)
+
+    @classmethod
+    def load(cls, file):
+        clusters = []
+        with open(file, 'r') as f:
+            for line in json_lines.reader(f):
+                clusters.append(line)
+        return cls(clusters, os.path.getmtime(file))
+
+    def search(self, entity_uri):
+        i = self.cluster_of.get(entity_uri)
+        return self.clusters[i] if i is not None else []
+
+
+def has_gt(repo, graph):
+    _, file = gt_file(repo, graph)
     return os.path.isfile(file)
 
 
+def get_index(repo, graph):
+    gtid, file = gt_file(repo, graph)
+    if not os.path.isfile(file):
+        return None
+    mtime = os.path.getmtime(file)
+    index = groundtruth.get(gtid)
+    if index is None or index.mtime != mtime:
+        with groundtruth_lock:
+            index = groundtruth.get(gtid)
+            if index is None or index.mtime != mtime:
+                index = groundtruth[gtid] = GroundtruthIndex.load(file)
+    return index
+
+
 # returns a list of members in the gt cluster
 def search_cluster(repo, graph, entity_uri):
-    gtid = repo
-    if graph:
-        gtid = gtid + repo + '-' + re.sub('[^0-9a-zA-Z]+', '-', graph)
+    index = get_index(repo, graph)
+    return index.search(entity_uri) if index else []
 
-    if gtid not in groundtruth:
-        file = 'gt/' + gtid + 'jl'
-        groundtruth[gtid] = []
-        with open(file, 'r') as f:
-            for line in json_lines.reader(f):
-                groundtruth[gtid].append(line)
 
-    for cluster in groundtruth[gtid]:
-        if entity_uri in cluster:
-            return cluster
+# returns the members of the gt cluster of the first of `members` that has one
+def find_cluster(repo, graph, members):
+    index = get_index(repo, graph)
+    if index:
+        for m in members:
+            cluster = index.search(m)
+            if cluster:
+                return cluster
     return []
 
 
 def get_all():
-    return groundtruth
+    return {gtid: index.clusters for gtid, index in groundtruth.items()}
@@ -0,0 +1,191 @@
+from concurrent.futures import ThreadPoolExecutor
+import groundtruth as gt
+import threading
+import shutil
+import debug
+import gzip
+import json
+import time
+import uuid
+import os
+import setting
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+CHUNK_SIZE = 1 << 20
+
+DEBUG = 'debug'
+GROUNDTRUTH = 'groundtruth'
+
+jobs = {}  # job id to Job
+jobs_lock = threading.Lock()
+executor = ThreadPoolExecutor(max_workers=setting.ingest_workers)
+
+
+class Job:
+    def __init__(self, kind, repo, graph, upload):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.repo = repo
+        self.graph = graph
+        self.upload = upload
+        self.status = 'queued'
+        self.stage = None
+        self.processed = 0
+        self.total = os.path.getsize(upload)
+        self.records = 0
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def to_json(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'repo': self.repo,
+            'graph': self.graph,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': self.processed / self.total if self.total else 1,
+            'records': self.records,
+            'error': self.error,
+            'created': self.created,
+            'finished': self.finished,
+        }
+
+
+def save_upload(stream, filename=None):
+    """
+    Copies an uploaded file to the upload directory in chunks and returns its path.
+    """
+    os.makedirs(setting.upload_data, exist_ok=True)
+    path = os.path.join(setting.upload_data, uuid.uuid4().hex + '-' + os.path.basename(filename or 'upload'))
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(stream, f, CHUNK_SIZE)
+    return path
+
+
+def open_upload(path):
+    """
+    Returns (line reader, raw file) of an uploaded .jl that may be gzip or zstd compressed.
+    """
+    raw = open(path, 'rb')
+    magic = raw.read(4)
+    raw.seek(0)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=raw), raw
+    if magic == ZSTD_MAGIC:
+        if zstandard is None:
+            raw.close()
+            raise ValueError('zstd compressed upload, but the zstandard package is not installed')
+        return zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True), raw
+    return raw, raw
+
+
+def submit(kind, repo, graph, upload):
+    job = Job(kind, repo, graph, upload)
+    with jobs_lock:
+        jobs[job.id] = job
+    executor.submit(_run, job)
+    return job
+
+
+def get_job(job_id):
+    return jobs.get(job_id)
+
+
+def _run(job):
+    job.status = 'running'
+    try:
+        if job.kind == DEBUG:
+            _ingest_debug(job)
+        else:
+            _ingest_groundtruth(job)
+        job.status = 'done'
+    except Exception as e:
+        job.status = 'failed'
+        job.error = str(e)
+    finally:
+        job.finished = time.time()
+        if os.path.isfile(job.upload):
+            os.remove(job.upload)
+
+
+def validate_debug(record):
+    if not isinstance(record, dict) or not isinstance(record.get('all_records'), dict):
+        raise ValueError('a debug record needs an all_records object')
+
+
+def validate_groundtruth(record):
+    if not isinstance(record, list) or not all(isinstance(m, str) for m in record):
+        raise ValueError('a ground truth record must be a list of entity uris')
+
+
+def _compact(job, validate, out_path):
+    job.stage = 'validating'
+    reader, raw = open_upload(job.upload)
+    try:
+        with open(out_path, 'w', encoding='utf-8') as out:
+            for i, line in enumerate(_lines(reader), 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    validate(record)
+                except ValueError as e:
+                    raise ValueError('line %d: %s' % (i, e))
+                out.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+                job.records += 1
+                job.processed = raw.tell()
+    finally:
+        reader.close()
+        raw.close()
+
+
+def _lines(reader):
+    pending = b''
+    while True:
+        chunk = reader.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+
+def _ingest_debug(job):
+    version = debug.version_file(job.repo, job.graph)
+    os.makedirs(os.path.dirname(version), exist_ok=True)
+    try:
+        _compact(job, validate_debug, version)
+        job.stage = 'indexing'
+        job.processed = 0
+        job.total = os.path.getsize(version)
+        debug.build_index(version, lambda offset: setattr(job, 'processed', offset))
+        job.stage = 'publishing'
+        debug.publish(job.repo, job.graph, version)
+    except Exception:
+        for path in (version, debug.index_file(version)):
+            if os.path.isfile(path):
+                os.remove(path)
+        raise
+
+
+def _ingest_groundtruth(job):
+    _, target = gt.gt_file(job.repo, job.graph)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    staging = '%s.%s.staging' % (target, job.id)
+    try:
+        _compact(job, validate_groundtruth, staging)
+        job.stage = 'publishing'
+        os.replace(staging, target)
+    finally:
+        if os.path.isfile(staging):
+            os.remove(staging)
@@ -0,0 +1,87 @@
+import tempfile
+import struct
+import mmap
+import json
+import os
+
+MAGIC = b'GAIAKEY1'
+HEADER = struct.Struct('<8sQQQ')  # magic, number of records, position of the offset table, length of meta
+
+
+class KeyFile:
+    """
+    Read-only, memory-mapped file of `key -> value` records sorted by key. A lookup is a binary search
+    over the offset table at the end of the file and touches only the pages it reads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.__file = open(path, 'rb')
+        self.__mm = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__offsets = None
+        magic, self.count, table, meta_length = HEADER.unpack_from(self.__mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('%s is not a key file' % path)
+        self.meta = json.loads(self.__mm[HEADER.size:HEADER.size + meta_length].decode('utf-8'))
+        self.__offsets = memoryview(self.__mm)[table:table + 8 * self.count].cast('Q')
+
+    def _key_at(self, i):
+        start = self.__offsets[i]
+        return self.__mm[start:self.__mm.find(b'\t', start)]
+
+    def get(self, key, default=None):
+        key = key.encode('utf-8')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._key_at(lo) == key:
+            start = self.__offsets[lo] + len(key) + 1
+            return self.__mm[start:self.__mm.find(b'\n', start)].decode('utf-8')
+        return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        if self.__offsets is not None:
+            self.__offsets.release()
+            self.__offsets = None
+        self.__mm.close()
+        self.__file.close()
+
+
+def write(path, items, meta=None):
+    """
+    Writes (key, value) pairs to a key file at `path`, replacing it atomically.
+    Keys and values must not contain tabs or newlines; for duplicated keys the last value wins.
+    """
+    records = {}
+    for key, value in items:
+        records[key.encode('utf-8')] = value.encode('utf-8')
+    meta = json.dumps(meta or {}).encode('utf-8')
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, 0, 0, 0))
+            f.write(meta)
+            offsets = []
+            for key in sorted(records):
+                offsets.append(f.tell())
+                f.write(key + b'\t' + records[key] + b'\n')
+            f.write(b'\0' * (-f.tell() % 8))
+            table = f.tell()
+            f.write(struct.pack('<%dQ' % len(offsets), *offsets))
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, len(offsets), table, len(meta)))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -1,21 +1,31 @@
-from rdflib.plugins.stores.sparqlstore import SPARQLStore
 from source_context import LTFSourceContext
 from rdflib import URIRef, Literal
 from rdflib.namespace import Namespace, RDF, SKOS, split_uri
-from collections import namedtuple, Counter
+from collections import namedtuple, Counter, OrderedDict, defaultdict
 import pickle
-from setting import wikidata_endpoint, groundtruth_url
-import requests
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout, wait
+import threading
+import hashlib
+import time
+import setting
+import groundtruth as gt
 import debug
 import json
 import os
 import tmp
-import time_person_label
+import summary
+import render
 import re
+import store
+import query_cache
+import wikidata
+from wikidata import freebase_mid, geonames_id
+import adjacency
+from adjacency import SuperEdgeIndex
+from cluster_index import ClusterIndex, ClusterPage, encode_cursor, valid_cursor, sort_keys
 
-wikidata_sparql = SPARQLStore(wikidata_endpoint)
 AIDA = Namespace('https://tac.nist.gov/tracks/SM-KBP/2019/ontologies/InterchangeOntology#')
-WDT = Namespace('http://www.wikidata.org/prop/direct/')
+WDT = wikidata.WDT
 namespaces = {
     'aida': AIDA,
     'rdf': RDF,
@@ -23,21 +33,114 @@ namespaces = {
     'wdt': WDT
 }
 types = namedtuple('AIDATypes', ['Entity', 'Events', 'Relation'])(AIDA.Entity, AIDA.Event, AIDA.Relation)
+HYDRATE_BATCH_SIZE = 500  # members bound per VALUES clause
+prefetch_pool = ThreadPoolExecutor(max_workers=setting.prefetch_workers)
+
+
+def values_clause(var, terms):
+    return 'VALUES ?%s { %s }' % (var, ' '.join(URIRef(t).n3() for t in terms))
+
+
+def keyset_condition(columns, values, after=True):
+    """
+    SPARQL condition selecting the rows that come after (or before) `values` in the order given by
+    `columns`, a list of (expression, descending) pairs.
+    """
+    def term(value):
+        return str(value) if isinstance(value, int) else Literal(str(value)).n3()
+
+    clauses = []
+    for i, ((expr, desc), value) in enumerate(zip(columns, values)):
+        equal = ['%s = %s' % (e, term(v)) for (e, _), v in zip(columns[:i], values[:i])]
+        op = '<' if desc == after else '>'
+        clauses.append('(%s)' % ' && '.join(equal + ['%s %s %s' % (expr, op, term(value))]))
+    return ' || '.join(clauses)
+
+
+def summary_file(repo, graph, kind=None):
+    pkl_file = 'pkl/' + repo
+    if graph:
+        pkl_file = pkl_file + '-' + re.sub('[^0-9a-zA-Z]+', '-', graph)
+    if kind:
+        pkl_file = pkl_file + '-' + kind
+    return pkl_file + '.pkl'
+
+
+def build_summaries(sparql, repo, graph):
+    """
+    Builds or refreshes the cluster summary of a graph; the member and adjacency indexes, which are built from
+    the whole graph, are rebuilt whenever the summary changed. The summary is written last, a model reloads
+    once it changes and must find the indexes of the same graph by then.
+    """
+    pkl_file = summary_file(repo, graph)
+    refreshed = summary.refresh(sparql, graph, pkl_file, namespaces, AIDA)
+    members_file = summary_file(repo, graph, 'members')
+    if refreshed is not None or not os.path.isfile(members_file):
+        tmp.run_members(sparql, graph, members_file, namespaces)
+    if setting.precompute_adjacency:
+        adj_file = summary_file(repo, graph, 'adjacency')
+        if refreshed is not None or not os.path.isfile(adj_file):
+            adjacency.run(sparql, graph, adj_file, namespaces)
+    if refreshed is not None:
+        summary.write(pkl_file, refreshed)
+    return refreshed is not None
+
+
+def summaries_exist(repo, graph):
+    kinds = [None, 'members'] + (['adjacency'] if setting.precompute_adjacency else [])
+    return all(os.path.isfile(summary_file(repo, graph, kind)) for kind in kinds)
 
 
 class Model:
     def __init__(self, sparql, repo, graph):
-        self.__sparql = sparql
+        self.__store = sparql
+        self.__sparql = query_cache.CachedStore(sparql, repo, graph)
         self.__repo = repo
         self.__graph = graph
-        pkl_file = 'pkl/' + repo
-        if graph:
-            pkl_file = pkl_file + '-' + re.sub('[^0-9a-zA-Z]+', '-', graph)
-        pkl_file = pkl_file + '.pkl'
-        if not os.path.isfile(pkl_file):
-            tmp.run(sparql, graph, pkl_file, namespaces, AIDA)
-            time_person_label.run(sparql, graph, pkl_file, namespaces)
-        self.__pickled = pickle.load(open(pkl_file, 'rb'))
+        pkl_file = summary_file(repo, graph)
+        if summaries_exist(repo, graph):
+            # the files are served as they are and the graph is checked in the background once the summary is
+            # older than summary_check_interval, a model reloaded after a refresh is not checked again at once
+            self.__checked = os.path.getmtime(pkl_file)
+        else:
+            build_summaries(sparql, repo, graph)
+            self.__checked = time.time()
+        members_file = summary_file(repo, graph, 'members')
+        with open(members_file, 'rb') as f:
+            self.__member_clusters = pickle.load(f)
+        self.__adjacency = None
+        adj_size = 0
+        if setting.precompute_adjacency:
+            adj_file = summary_file(repo, graph, 'adjacency')
+            self.__adjacency = SuperEdgeIndex.load(adj_file)
+            adj_size = os.path.getsize(adj_file)
+        stat = os.stat(pkl_file)
+        self.__pkl_file = pkl_file
+        self.__pkl_mtime = stat.st_mtime
+        self.__pkl_size = stat.st_size + os.path.getsize(members_file) + adj_size
+        self.__pickled = summary.load(pkl_file).clusters
+        self.__index = None
+
+    @property
+    def footprint(self):
+        # the size of the pickle on disk is used as a proxy for the memory of the loaded summary
+        return self.__pkl_size
+
+    def is_stale(self):
+        try:
+            return os.path.getmtime(self.__pkl_file) != self.__pkl_mtime
+        except OSError:
+            return True
+
+    def refresh_due(self):
+        return time.time() - self.__checked > setting.summary_check_interval
+
+    def refresh(self):
+        """
+        Rewrites the summaries if the graph changed since they were built, the model is then stale.
+        """
+        self.__checked = time.time()
+        return build_summaries(self.__store, self.__repo, self.__graph)
 
     @property
     def graph(self):
@@ -55,12 +158,47 @@ class Model:
     def pickled(self):
         return self.__pickled
 
+    @property
+    def member_clusters(self):
+        return self.__member_clusters
+
+    @property
+    def adjacency(self):
+        return self.__adjacency
+
+    @property
+    def index(self):
+        if self.__index is None:
+            self.__index = ClusterIndex(self.__pickled, str(AIDA.Relation))
+        return self.__index
+
+    def cluster_href(self, uri):
+        if 'http://www.isi.edu/gaia' in uri:
+            href = uri.replace('http://www.isi.edu/gaia', '/cluster')
+            href = href.replace('/entities', '/entities/' + self.repo)
+            href = href.replace('/events', '/events/' + self.repo)
+            href = href.replace('/relations', '/relations/' + self.repo)
+        else:
+            href = uri.replace('http://www.columbia.edu', '/cluster/' + self.repo)
+        if self.graph:
+            href = href + '?g=' + self.graph
+        return href
+
     def get_cluster(self, uri):
-        if Cluster.ask(self.__sparql, self.__graph, uri):
-            return Cluster(self, uri)
+        cluster = Cluster(self, uri)
+        if str(uri) in self.__pickled:
+            return cluster
+        # not summarised: the prototype query doubles as the existence check
+        if cluster.prototype:
+            return cluster
         return None
 
     def get_cluster_list(self, type_=None, limit=10, offset=0, sortby='size'):
+        if type_ and self.index.available:
+            for e in self.index.page(type_, limit, offset, sortby):
+                yield ClusterSummary(e.uri, self.cluster_href(e.uri), e.label, e.count)
+            return
+
         open_clause = close_clause = ''
         if self.__graph:
             open_clause = 'GRAPH <%s> {' % self.__graph
@@ -106,16 +244,92 @@ class Model:
             c = r.memberN
             if isinstance(l, URIRef):
                 _, l = split_uri(l)
-            if 'http://www.isi.edu/gaia' in u:
-                href = u.replace('http://www.isi.edu/gaia', '/cluster')
-                href = href.replace('/entities', '/entities/' + self.repo)
-                href = href.replace('/events', '/events/' + self.repo)
-                href = href.replace('/relations', '/relations/' + self.repo)
+            yield ClusterSummary(u, self.cluster_href(u), l, c)
+
+    def list_order(self, type_, sortby='size'):
+        """
+        The order the cluster list of `type_` is given in when sorted by `sortby`, cursors must be decoded for
+        it: the summary index sorts by size, type or label, SPARQL by size, or by type for events only.
+        """
+        if self.index.available:
+            return sortby if sortby in sort_keys else 'size'
+        if sortby == 'type' and type_ != AIDA.Entity:
+            return 'type'
+        return 'size'
+
+    def get_cluster_page(self, type_, limit=100, after=None, before=None, sortby='size'):
+        """
+        A page of the cluster list positioned by cursor (the sort values of a neighbouring row) instead of an
+        offset, so that every page costs the same. `after` and `before` are decoded cursors.
+        """
+        sortby = self.list_order(type_, sortby)
+        if self.index.available:
+            page = self.index.keyset_page(type_, limit, after, before, sortby)
+            return ClusterPage([ClusterSummary(e.uri, self.cluster_href(e.uri), e.label, e.count)
+                                for e in page.clusters], page.next, page.prev)
+
+        open_clause = close_clause = ''
+        if self.__graph:
+            open_clause = 'GRAPH <%s> {' % self.__graph
+            close_clause = '}'
+        if type_ == AIDA.Entity:
+            label_string = 'OPTIONAL {?prototype aida:hasName ?label} .'
+        else:
+            label_string = '?s rdf:subject ?prototype ; rdf:predicate rdf:type ; rdf:object ?label .'
+        # HAVING and ORDER BY are evaluated before the projection, so they can't use the ?memberN alias
+        if sortby == 'type':
+            columns = [('STR(?label)', False), ('COUNT(?member)', True), ('STR(?cluster)', False)]
+        else:
+            columns = [('COUNT(?member)', True), ('STR(?cluster)', False)]
+        after = valid_cursor(after, sortby)
+        before = valid_cursor(before, sortby)
+        cursor = before if before is not None else after
+        forward = before is None
+        having = ''
+        if cursor is not None:
+            having = 'HAVING (%s)' % keyset_condition(columns, cursor, forward)
+        order_by = ' '.join('%s(%s)' % ('DESC' if desc == forward else 'ASC', expr) for expr, desc in columns)
+        query = """
+    SELECT ?cluster ?label (COUNT(?member) AS ?memberN)
+    WHERE {
+        %s
+        ?cluster aida:prototype ?prototype .
+        ?prototype a %s .
+        %s
+        ?membership aida:cluster ?cluster ;
+                  aida:clusterMember ?member .
+        MINUS {?cluster aida:prototype ?member}
+        %s
+    }
+    GROUP BY ?cluster ?label
+    %s
+    ORDER BY %s
+    LIMIT %d
+    """ % (open_clause, URIRef(type_).n3(), label_string, close_clause, having, order_by, limit + 1)
+
+        rows = [r for r in self.__sparql.query(query, namespaces) if r.cluster]
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if not forward:
+            rows.reverse()
+        clusters = []
+        cursors = []
+        for r in rows:
+            l = r.label
+            if isinstance(l, URIRef):
+                _, l = split_uri(l)
+            clusters.append(ClusterSummary(r.cluster, self.cluster_href(r.cluster), l, r.memberN))
+            if sortby == 'type':
+                cursors.append([str(r.label), int(r.memberN), str(r.cluster)])
             else:
-                href = u.replace('http://www.columbia.edu', '/cluster/' + self.repo)
-            if self.graph:
-                href = href + '?g=' + self.graph
-            yield ClusterSummary(u, href, l, c)
+                cursors.append([int(r.memberN), str(r.cluster)])
+        if not clusters:
+            return ClusterPage([], None, None)
+        has_next = more if forward else True
+        has_prev = (after is not None) if forward else more
+        return ClusterPage(clusters,
+                           encode_cursor(cursors[-1]) if has_next else None,
+                           encode_cursor(cursors[0]) if has_prev else None)
 
     def recover_doc_online(self, doc_id):
         import json
@@ -144,6 +358,88 @@ class Model:
         return doc_recover
 
 
+class ModelRegistry:
+    """
+    Process wide LRU of loaded models keyed by (repo, graph), bounded by the total size of their summaries.
+    Every `summary_check_interval` seconds a model checks its graph for changes in the background; it is
+    reloaded once its summary pickle has been rewritten.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.__models = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__loading = defaultdict(threading.Lock)
+        self.__refreshing = defaultdict(threading.Lock)
+
+    def get(self, repo, graph):
+        key = (repo, graph or '')
+        model = self._lookup(key)
+        if model:
+            if model.refresh_due():
+                self._refresh(key, model)
+            return model
+        with self.__loading[key]:
+            model = self._lookup(key)
+            if not model:
+                model = Model(store.get_store(repo), repo, graph)
+                self._add(key, model)
+        return model
+
+    def _refresh(self, key, model):
+        """
+        Checks the graph of `model` for changes in a background thread, one at a time per (repo, graph); the
+        loaded model is served meanwhile and replaced by the first lookup after its summary was rewritten.
+        """
+        lock = self.__refreshing[key]
+        if not lock.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                model.refresh()
+            except Exception as e:
+                print('refreshing %s %s failed, %r' % (key[0], key[1] or '(default graph)', e))
+            finally:
+                lock.release()
+
+        threading.Thread(target=run, name='refresh %s %s' % key, daemon=True).start()
+
+    def _lookup(self, key):
+        with self.__lock:
+            model = self.__models.get(key)
+            if model is None:
+                return None
+            if model.is_stale():
+                del self.__models[key]
+                model.sparql.invalidate()
+                return None
+            self.__models.move_to_end(key)
+            return model
+
+    def _add(self, key, model):
+        with self.__lock:
+            self.__models[key] = model
+            self.__models.move_to_end(key)
+            while len(self.__models) > 1 and self.footprint > self.budget:
+                self.__models.popitem(last=False)
+
+    @property
+    def footprint(self):
+        return sum(m.footprint for m in self.__models.values())
+
+    def invalidate(self, repo, graph=None):
+        with self.__lock:
+            for key in [k for k in self.__models if k[0] == repo and (graph is None or k[1] == (graph or ''))]:
+                del self.__models[key]
+
+
+models = ModelRegistry(setting.model_cache_mb * 1024 * 1024)
+
+
+def get_model(repo, graph):
+    return models.get(repo, graph)
+
+
 class Cluster:
     def __init__(self, model, uri):
         self.model = model
@@ -157,12 +453,17 @@ class Cluster:
         self.__selected_targets = None
         self.__target_wiki = None
         self.__freebases = None
-        self.__qids = Counter()
+        self.__qids = None
         self.__selected_qnodes = None
-        self.__q_urls = {}
+        self.__q_urls = None
         self.__groundtruth = None
         self.__debug_info = None
         self.__all_labels = None
+        self.__prototype_lock = threading.Lock()
+        self.__members_lock = threading.Lock()
+        self.__qnodes_lock = threading.Lock()
+        self.__groundtruth_lock = threading.Lock()
+        self.__debug_lock = threading.Lock()
 
         if model.graph:
             self.__open_clause = 'GRAPH <%s> {' % self.model.graph
@@ -200,7 +501,9 @@ class Cluster:
     @property
     def prototype(self):
         if not self.__prototype:
-            self._init_cluster_prototype()
+            with self.__prototype_lock:
+                if not self.__prototype:
+                    self._init_cluster_prototype()
         return self.__prototype
 
     @property
@@ -208,19 +511,23 @@ class Cluster:
         if self.uri in self.model.pickled and 'type' in self.model.pickled[self.uri]:
             return self.model.pickled[self.uri]['type']
         if not self.__type:
-            self._init_cluster_prototype()
+            self.prototype
         return self.__type
 
+    def _ensure_members(self):
+        if self.__targets is None:
+            with self.__members_lock:
+                if self.__targets is None:
+                    self._init_cluster_members()
+
     @property
     def members(self):
-        if not self.__members:
-            self._init_cluster_members()
+        self._ensure_members()
         return self.__members
 
     @property
     def targets(self):
-        if self.__targets is None:
-            self._init_cluster_members()
+        self._ensure_members()
         return self.__targets.most_common()
 
     @property
@@ -234,24 +541,27 @@ class Cluster:
 
     @property
     def target_wiki(self):
-        if self.__target_wiki is None:
-            self._init_cluster_members()
+        self._ensure_members()
         return self.__target_wiki
 
     @property
     def freebases(self):
-        if self.__freebases is None:
-            self._init_cluster_members()
+        self._ensure_members()
         return self.__freebases.most_common()
 
     @property
     def targetsSize(self):
         return len(self.targets)
 
+    def _ensure_qnodes(self):
+        if self.__qids is None:
+            with self.__qnodes_lock:
+                if self.__qids is None:
+                    self._init_qnodes()
+
     @property
     def qids(self):
-        if not self.__qids:
-            self._init_qnodes()
+        self._ensure_qnodes()
         return self.__qids.most_common()
 
     @property
@@ -268,13 +578,12 @@ class Cluster:
 
     @property
     def q_urls(self):
-        if not self.__q_urls:
-            self._init_qnodes()
+        self._ensure_qnodes()
         return self.__q_urls
 
     @property
     def size(self):
-        if self.__members:
+        if self.__targets is not None:
             return len(self.__members)
         return self._query_for_size()
 
@@ -297,33 +606,30 @@ class Cluster:
         return self.forward | self.backward
 
     def neighborhood(self, hop=1):
-        if hop == 1 and self.prototype.type != AIDA.Relation:
-            hood = self.neighbors
-            # for neighbor in [x for x in self.neighbors if x.subject.proto]
-            for neighbor in self.neighbors:
-                if neighbor.subject.prototype.type == AIDA.Relation:
-                    hood |= neighbor.subject.neighbors
-            return hood
-        if hop <= 1:
-            return self.neighbors
-        hood = set()
-        for neighbor in self.neighbors:
-            hood |= neighbor.subject.neighborhood(hop-1)
-            hood |= neighbor.object.neighborhood(hop-1)
-        return hood
+        return Neighborhood(self.model).explore(self, hop)
 
     @property
     def img(self):
-        import os.path
+        """
+        Name of the neighbourhood graph, which is rendered in the background if it is not yet; the page
+        polls /render/<name> for it.
+        """
+        render.service.submit(self.graph_name, self.neighborhood_graph)
+        return self.graph_name
+
+    @property
+    def graph_name(self):
+        """
+        Name the neighbourhood graph is rendered and served under. A cluster URI may be in several repositories
+        and graphs, each with a neighbourhood of its own, so its local name is followed by a hash of all three.
+        """
         _, name = split_uri(self.uri)
-        svgpath = 'static/img/' + name + '.svg'
-        if os.path.isfile(svgpath):
-            return name
+        key = '\n'.join((self.model.repo, self.model.graph or '', str(self.uri)))
+        return '%s-%s' % (name, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
 
+    def neighborhood_graph(self):
         from graph import SuperEdgeBasedGraph
-        graph = SuperEdgeBasedGraph(self.model, self.neighborhood(), self, self.uri)
-        path = graph.dot()
-        return graph.name
+        return SuperEdgeBasedGraph(self.model, self.neighborhood(), self, self.uri)
 
     @classmethod
     def ask(cls, sparql, graph, uri):
@@ -340,7 +646,9 @@ class Cluster:
     @property
     def groundtruth(self):
         if self.__groundtruth is None:
-            self._init_groundtruth()
+            with self.__groundtruth_lock:
+                if self.__groundtruth is None:
+                    self._init_groundtruth()
         return self.__groundtruth
 
     @property
@@ -350,18 +658,39 @@ class Cluster:
     @property
     def debug_info(self):
         if self.__debug_info is None:
-            if debug.has_debug(self.model.repo, self.model.graph):
-                self._init_debug_info()
-            else:
-                self.__debug_info = False
+            with self.__debug_lock:
+                if self.__debug_info is None:
+                    if debug.has_debug(self.model.repo, self.model.graph):
+                        self._init_debug_info()
+                    else:
+                        self.__debug_info = False
         return self.__debug_info
 
+    def prefetch(self, show_image=True, deadline=setting.prefetch_deadline):
+        """
+        Load the independent parts of a cluster page concurrently so that rendering takes about as long
+        as the slowest of them. Whatever is not done within `deadline` seconds is left to the lazy properties.
+        """
+        end = time.time() + deadline
+        members = prefetch_pool.submit(self._ensure_members)
+        futures = [members, prefetch_pool.submit(lambda: self.prototype)]
+        if show_image:
+            futures.append(prefetch_pool.submit(lambda: self.img))
+        try:
+            members.result(timeout=max(0, end - time.time()))
+        except FuturesTimeout:
+            return
+        futures.append(prefetch_pool.submit(self._ensure_qnodes))
+        futures.append(prefetch_pool.submit(lambda: self.groundtruth))
+        wait(futures, timeout=max(0, end - time.time()))
+
     def _init_cluster_prototype(self):
         query = """
 SELECT ?prototype (MIN(?label) AS ?mlabel) ?type ?category
 WHERE {
     %s
-    ?cluster aida:prototype ?prototype .
+    ?cluster a aida:SameAsCluster ;
+             aida:prototype ?prototype .
     ?prototype a ?type .
     OPTIONAL { ?prototype aida:hasName ?label } .
     OPTIONAL { ?statement a rdf:Statement ;
@@ -378,9 +707,10 @@ GROUP BY ?prototype ?type ?category """ % (self.__open_clause, self.__close_clau
             self.__type = cate
 
     def _init_cluster_members(self):
-        self.__targets = Counter()
-        self.__target_wiki = {}
-        self.__freebases = Counter()
+        members = []
+        targets = Counter()
+        target_wiki = {}
+        freebases = Counter()
         query = """
 SELECT ?member (MIN(?label) AS ?mlabel) ?type
 WHERE {
@@ -403,46 +733,39 @@ GROUP BY ?member ?type """ % (self.__open_clause, self.__close_clause)
                               label=label,
                               type_=type_,
                               debug_info=self.debug_info.members[str(member)]['raw_object'])
-            self.__members.append(m)
+            members.append(m)
+
+        ClusterMember.hydrate(self.model, members)
+        for m in members:
             for target in m.targets.keys():
-                self.__targets[target] += 1
+                targets[target] += 1
             for freebase in m.freebases.keys():
-                self.__freebases[freebase] += 1
+                freebases[freebase] += 1
 
-        query = '''
-SELECT ?qnode ?qnodeLabel 
-WHERE 
-{
-    ?qnode wdt:P1566 ?target .
-    SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
-} '''
-        for target in self.__targets.keys():
-            target_t = target[target.index(':')+1:]
-            for qnode, qnodeLabel in wikidata_sparql.query(query, namespaces, {'target': Literal(target_t)}):
-                url = str(qnode)
-                qnode = url[url.rfind('/')+1:]
-                self.__target_wiki[target] = {}
-                self.__target_wiki[target]['qnode'] = qnode
-                self.__target_wiki[target]['url'] = url
-                self.__target_wiki[target]['label'] = str(qnodeLabel)
+        wiki = wikidata.resolver.geonames([geonames_id(target) for target in targets])
+        for target in targets.keys():
+            if geonames_id(target) in wiki:
+                target_wiki[target] = dict(wiki[geonames_id(target)])
+
+        self.__members = members
+        self.__target_wiki = target_wiki
+        self.__freebases = freebases
+        self.__targets = targets
 
     def _init_qnodes(self):
-        for fbid, count in self.freebases:
-            if ":NIL" not in fbid:
-                fbid = '/' + fbid.replace('.', '/')
-                query = """
-                    SELECT ?qid ?label WHERE {
-                      ?qid wdt:P646 ?freebase .  
-                      ?qid rdfs:label ?label filter (lang(?label) = "en") .
-                    }
-                    LIMIT 1
-                """
-                for qid, label in wikidata_sparql.query(query, namespaces, {'freebase': Literal(fbid)}):
-                    qnodeURL = str(qid)
-                    qid = qnodeURL.rsplit('/', 1)[1]
-                    self.__qids[qid] = count
-                    if qid not in self.__q_urls:
-                        self.__q_urls[qid] = qnodeURL
+        qids = Counter()
+        q_urls = {}
+        # resolves the freebase ids of every member at once, members then find theirs in the resolver cache
+        fbids = [(fbid, count) for fbid, count in self.freebases if ":NIL" not in fbid]
+        wiki = wikidata.resolver.freebase([freebase_mid(fbid) for fbid, _ in fbids])
+        for fbid, count in fbids:
+            q = wiki.get(freebase_mid(fbid))
+            if q:
+                qids[q['qid']] = count
+                if q['qid'] not in q_urls:
+                    q_urls[q['qid']] = q['url']
+        self.__q_urls = q_urls
+        self.__qids = qids
 
     def _init_groundtruth(self):
         # query to find cluster of the missing member
@@ -456,19 +779,12 @@ WHERE
             }
         ''' % (self.__open_clause, self.__close_clause)
 
+        if not gt.has_gt(self.model.repo, self.model.graph):
+            self.__groundtruth = False
+            return
+
         member_set = set([str(m.uri) for m in self.members])
-        gt_set = set()
-        for m in member_set:
-            if self.model.graph:
-                res = requests.get(groundtruth_url + '/' + self.model.repo + '?g=' + self.model.graph + '&e=' + m)
-            else:
-                res = requests.get(groundtruth_url + '/' + self.model.repo + '?e=' + m)
-            if res.status_code == 404:
-                self.__groundtruth = False
-                return
-            if len(res.json()) > 0:
-                gt_set = set(res.json())
-                break
+        gt_set = set(gt.find_cluster(self.model.repo, self.model.graph, member_set))
 
         if len(gt_set) > 0:
             hit = member_set.intersection(gt_set)
@@ -476,10 +792,13 @@ WHERE
             missing = gt_set.difference(member_set)
             missing_dict = {}
 
-            if missing:
-                for m in missing:
-                    for c, in self.model.sparql.query(query, namespaces, {'member': URIRef(m)}):
-                        missing_dict[m] = str(c).replace('http://www.isi.edu/gaia/entities/', '')
+            for m in missing:
+                c = self.model.member_clusters.get(m)
+                if c:
+                    missing_dict[m] = c.replace('http://www.isi.edu/gaia/entities/', '')
+                    continue
+                for c, in self.model.sparql.query(query, namespaces, {'member': URIRef(m)}):
+                    missing_dict[m] = str(c).replace('http://www.isi.edu/gaia/entities/', '')
 
             self.__groundtruth = Groundtruth(gt_set, hit, miss, missing_dict)
 
@@ -494,6 +813,10 @@ WHERE
             self.__debug_info = False
 
     def _init_forward_clusters(self):
+        if self.model.adjacency:
+            for p, o, cnt in self.model.adjacency.forward(self.uri):
+                self.__forward.add(SuperEdge(self, Cluster(self.model, o), p, cnt))
+            return
         query = """
 SELECT ?p ?o ?cnt
 WHERE {
@@ -511,6 +834,10 @@ WHERE {
             self.__forward.add(SuperEdge(self, Cluster(self.model, o), p, int(float(str(cnt)))))
 
     def _init_backward_clusters(self):
+        if self.model.adjacency:
+            for p, s, cnt in self.model.adjacency.backward(self.uri):
+                self.__backward.add(SuperEdge(Cluster(self.model, s), self, p, cnt))
+            return
         query = """
 SELECT ?s ?p ?cnt
 WHERE {
@@ -550,6 +877,125 @@ WHERE {
         return isinstance(other, Cluster) and str(self.uri) == str(other.uri)
 
 
+class Neighborhood:
+    """
+    Breadth-first traversal of the super-edges around a cluster. Every hop expands the whole frontier with
+    one query, clusters are shared between branches, and the traversal stops growing once the node or edge
+    budget is spent (`truncated` is set then).
+    """
+    def __init__(self, model, max_nodes=setting.neighborhood_max_nodes, max_edges=setting.neighborhood_max_edges):
+        self.model = model
+        self.max_nodes = max_nodes
+        self.max_edges = max_edges
+        self.clusters = {}  # uri to Cluster
+        self.nodes = set()
+        self.edges = set()
+        self.truncated = False
+        self.__relations = {}  # uri to whether its prototype is a relation
+
+        if model.graph:
+            self.__open_clause = 'GRAPH <%s> {' % self.model.graph
+            self.__close_clause = '}'
+        else:
+            self.__open_clause = self.__close_clause = ''
+
+    def cluster(self, uri):
+        uri = URIRef(uri)
+        if uri not in self.clusters:
+            self.clusters[uri] = Cluster(self.model, uri)
+        return self.clusters[uri]
+
+    def explore(self, root, hop=1):
+        self.clusters[root.uri] = root
+        self.nodes.add(root.uri)
+        visited = set()
+        frontier = {root.uri}
+        for _ in range(max(hop, 1)):
+            frontier -= visited
+            if not frontier or self.truncated:
+                break
+            visited |= frontier
+            frontier = self._add_edges(self._expand(frontier))
+
+        # relations are shown together with their arguments, so relation clusters reached as a subject
+        # are expanded one more time
+        if hop > 1 or not self._relations([root.uri])[root.uri]:
+            subjects = {e.subject.uri for e in self.edges} - visited
+            relations = [uri for uri, is_relation in self._relations(subjects).items() if is_relation]
+            if relations and not self.truncated:
+                self._add_edges(self._expand(relations))
+        return set(self.edges)
+
+    def _add_edges(self, found):
+        reached = set()
+        for s, p, o, cnt in found:
+            if self.truncated:
+                break
+            new_nodes = {s, o} - self.nodes
+            if len(self.edges) >= self.max_edges or len(self.nodes) + len(new_nodes) > self.max_nodes:
+                self.truncated = True
+                break
+            edge = SuperEdge(self.cluster(s), self.cluster(o), p, cnt)
+            if edge not in self.edges:
+                self.edges.add(edge)
+                self.nodes |= new_nodes
+                reached |= {s, o}
+        return reached
+
+    def _expand(self, uris):
+        if self.model.adjacency:
+            yield from self.model.adjacency.edges(uris)
+            return
+        query = """
+SELECT ?s ?p ?o ?cnt
+WHERE {
+    %s
+  {
+    %s
+    ?s aida:prototype ?proto1 .
+  } UNION {
+    %s
+    ?o aida:prototype ?proto2 .
+  }
+  ?s aida:prototype ?proto1 .
+  ?o aida:prototype ?proto2 .
+  ?se rdf:subject ?proto1 ;
+      rdf:predicate ?p ;
+      rdf:object ?proto2 ;
+      aida:confidence/aida:confidenceValue ?conf .
+  BIND(ROUND(1/(2*(1-?conf))) as ?cnt)
+    %s
+} """ % (self.__open_clause, values_clause('s', uris), values_clause('o', uris), self.__close_clause)
+        for s, p, o, cnt in self.model.sparql.query(query, namespaces):
+            yield s, p, o, int(float(str(cnt)))
+
+    def _relations(self, uris):
+        unknown = []
+        for uri in uris:
+            if uri in self.__relations:
+                continue
+            summary = self.model.pickled.get(str(uri))
+            if summary and 'type' in summary:
+                self.__relations[uri] = summary['type'] == str(AIDA.Relation)
+            else:
+                unknown.append(uri)
+        if unknown:
+            for uri in unknown:
+                self.__relations[uri] = False
+            query = """
+SELECT ?cluster
+WHERE {
+    %s
+    %s
+    ?cluster aida:prototype ?prototype .
+    ?prototype a aida:Relation .
+    %s
+} """ % (self.__open_clause, values_clause('cluster', unknown), self.__close_clause)
+            for cluster, in self.model.sparql.query(query, namespaces):
+                self.__relations[cluster] = True
+        return {uri: self.__relations[uri] for uri in uris}
+
+
 class SuperEdge:
     def __init__(self, s: Cluster, o: Cluster, p: URIRef, n: int):
         self.subject = s
@@ -580,6 +1026,7 @@ class ClusterMember:
         self.__q_aliases = None
         self.__q_urls = None
         self.__source = None
+        self.__source_loaded = False
         self.__context_pos = []
         self.__context_extractor = None
         self.__cluster: Cluster = None
@@ -605,7 +1052,7 @@ class ClusterMember:
 
     @property
     def all_labels(self):
-        if not self.__all_labels:
+        if self.__all_labels is None:
             self.__all_labels = Counter()
             query = """
                 SELECT ?label (COUNT(?label) AS ?n)
@@ -652,13 +1099,13 @@ class ClusterMember:
     @property
     def targets(self):
         if self.__targets is None:
-            self._init_member()
+            self._init_links()
         return self.__targets
 
     @property
     def freebases(self):
         if self.__freebases is None:
-            self._init_member()
+            self._init_links()
         return self.__freebases
 
     @property
@@ -691,34 +1138,16 @@ class ClusterMember:
         self.__q_labels = {}
         self.__q_aliases = {}
 
-        for fbid, score in self.freebases.items():
-            if ":NIL" not in fbid:
-                fbid = '/' + fbid[fbid.find(':')+1:].replace('.', '/')
-                query = """
-                    SELECT ?qid ?label WHERE {
-                      ?qid wdt:P646 ?freebase .
-                      ?qid rdfs:label ?label filter (lang(?label) = "en") .
-                    }
-                    LIMIT 1
-                """
-                for q_url, label in wikidata_sparql.query(query, namespaces, {'freebase': Literal(fbid)}):
-                    qid = str(q_url).rsplit('/', 1)[1]
-                    self.__qids[qid] = score
-                    self.__q_urls[qid] = str(q_url)
-                    self.__q_labels[qid] = str(label)
-
-                query = """
-                    SELECT ?qid ?alias WHERE {
-                      ?qid wdt:P646 ?freebase .
-                      ?qid skos:altLabel ?alias filter (lang(?alias) = "en") .
-                    }
-                """
-                aliases = []
-                qid = None
-                for q_url, alias in wikidata_sparql.query(query, namespaces, {'freebase': Literal(fbid)}):
-                    qid = str(q_url).rsplit('/', 1)[1]
-                    aliases.append(str(alias))
-                self.__q_aliases[qid] = ', '.join(aliases)
+        fbids = [(fbid, score) for fbid, score in self.freebases.items() if ":NIL" not in fbid]
+        wiki = wikidata.resolver.freebase([freebase_mid(fbid) for fbid, _ in fbids])
+        for fbid, score in fbids:
+            q = wiki.get(freebase_mid(fbid))
+            if q:
+                qid = q['qid']
+                self.__qids[qid] = score
+                self.__q_urls[qid] = q['url']
+                self.__q_labels[qid] = q['label']
+                self.__q_aliases[qid] = q['aliases']
 
     @property
     def context_extractor(self):
@@ -800,12 +1229,123 @@ class ClusterMember:
 
     @property
     def cluster(self):
+        if self.__cluster is None and str(self.uri) in self.model.member_clusters:
+            self.__cluster = self.model.get_cluster(self.model.member_clusters[str(self.uri)])
         if self.__cluster is None:
             query = "SELECT ?cluster WHERE { %s ?membership aida:cluster ?cluster ; aida:clusterMember ?member . MINUS {?cluster aida:prototype ?member} %s}" % (self.__open_clause, self.__close_clause)
             for cluster, in self.model.sparql.query(query, namespaces, {'member': self.uri}):
                 self.__cluster = self.model.get_cluster(cluster)
         return self.__cluster
 
+    @staticmethod
+    def hydrate(model, members, batch_size=HYDRATE_BATCH_SIZE):
+        """
+        Load labels, types, link targets, freebase ids and justification offsets of all `members`
+        with a handful of VALUES-bound queries instead of several queries per member.
+        """
+        by_uri = {m.uri: m for m in members}
+        uris = list(by_uri.keys())
+        for i in range(0, len(uris), batch_size):
+            batch = [by_uri[uri] for uri in uris[i:i+batch_size]]
+            ClusterMember._hydrate_batch(model, batch)
+
+    @staticmethod
+    def _hydrate_batch(model, members):
+        by_uri = {m.uri: m for m in members}
+        no_debug = [m.uri for m in members if not m.__debug_info]
+        justified_labels = {uri: Counter() for uri in by_uri}
+        names = {uri: Counter() for uri in by_uri}
+        types_ = {}
+
+        query = """
+            SELECT ?member ?label (COUNT(?label) AS ?n)
+            WHERE {
+              %s
+              ?member aida:justifiedBy/skos:prefLabel ?label .
+            }
+            GROUP BY ?member ?label """ % values_clause('member', by_uri)
+        for member, label, n in model.sparql.query(query, namespaces):
+            if label:
+                justified_labels[member][" ".join(label.split())] += int(n)
+
+        query = """
+            SELECT ?member ?label (COUNT(?label) AS ?n)
+            WHERE {
+              %s
+              ?member aida:hasName ?label .
+            }
+            GROUP BY ?member ?label """ % values_clause('member', by_uri)
+        for member, label, n in model.sparql.query(query, namespaces):
+            if label:
+                names[member][" ".join(label.split())] += int(n)
+
+        query = """
+            SELECT ?member ?type
+            WHERE {
+              %s
+              ?statement rdf:subject ?member ;
+                         rdf:predicate rdf:type ;
+                         rdf:object ?type .
+            } """ % values_clause('member', by_uri)
+        for member, type_ in model.sparql.query(query, namespaces):
+            types_.setdefault(member, type_)
+
+        for uri, m in by_uri.items():
+            m.__all_labels = justified_labels[uri] + names[uri]
+            if not m.__type:
+                m.__type = types_.get(uri)
+            if not m.__label:
+                if names[uri]:
+                    m.__label = names[uri].most_common(1)[0][0]
+                elif justified_labels[uri]:
+                    m.__label = justified_labels[uri].most_common(1)[0][0]
+                elif m.__type:
+                    _, m.__label = split_uri(m.__type)
+            if m.__debug_info:
+                m._init_links_from_debug()
+            else:
+                m.__targets = {}
+                m.__freebases = {}
+
+        if no_debug:
+            query = """
+                SELECT ?member ?target
+                WHERE {
+                  %s
+                  ?member aida:link/aida:linkTarget ?target
+                } """ % values_clause('member', no_debug)
+            for member, target in model.sparql.query(query, namespaces):
+                by_uri[member].__targets[str(target)] = 0
+
+            query = """
+                SELECT DISTINCT ?member ?fbid {
+                   %s
+                   ?member aida:privateData [
+                        aida:jsonContent ?fbid ;
+                        aida:system <http://www.rpi.edu/EDL_Freebase>
+                    ]
+                } """ % values_clause('member', no_debug)
+            for member, j_fbid in model.sparql.query(query, namespaces):
+                by_uri[member]._add_freebases(j_fbid)
+
+        query = """
+            SELECT DISTINCT ?member ?source ?start ?end
+            WHERE {
+              %s
+              ?member aida:justifiedBy ?justification .
+              ?justification aida:source ?source ;
+                             aida:startOffset ?start ;
+                             aida:endOffsetInclusive ?end .
+            }
+            ORDER BY ?member ?start """ % values_clause('member', by_uri)
+        for m in members:
+            m.__context_pos = []
+            m.__source_loaded = True
+        for member, source, start, end in model.sparql.query(query, namespaces):
+            m = by_uri[member]
+            m.__source = str(source)
+            m.__context_pos.append((int(start), int(end)))
+
     def _init_member(self):
         query = """
 SELECT ?label ?type
@@ -824,43 +1364,53 @@ LIMIT 1 """
             self.__label = label
             self.__type = type_
 
+        self._init_links()
+
+    def _init_links(self):
         self.__targets = {}
+        self.__freebases = {}
         if self.__debug_info:
-            if self.__debug_info['targets']:
-                for i in range(0, len(self.__debug_info['targets'])):
-                    target = self.__debug_info['targets'][i]
-                    score = self.__debug_info['target_scores'][i]
-                    self.__targets[target] = score
-        else:
-            query = """
-                SELECT ?target
-                WHERE {
-                  ?member aida:link/aida:linkTarget ?target 
-                } """
-            for target, in self.model.sparql.query(query, namespaces, {'member': self.uri}):
-                self.__targets[str(target)] = 0
+            self._init_links_from_debug()
+            return
+
+        query = """
+            SELECT ?target
+            WHERE {
+              ?member aida:link/aida:linkTarget ?target 
+            } """
+        for target, in self.model.sparql.query(query, namespaces, {'member': self.uri}):
+            self.__targets[str(target)] = 0
+
+        query = """
+            SELECT DISTINCT ?fbid {
+               ?member aida:privateData [
+                    aida:jsonContent ?fbid ;
+                    aida:system <http://www.rpi.edu/EDL_Freebase>
+                ]
+            }
+        """
+        for j_fbid, in self.model.sparql.query(query, namespaces, {'member': self.uri}):
+            self._add_freebases(j_fbid)
+
+    def _init_links_from_debug(self):
+        self.__targets = {}
+        if self.__debug_info['targets']:
+            for i in range(0, len(self.__debug_info['targets'])):
+                target = self.__debug_info['targets'][i]
+                score = self.__debug_info['target_scores'][i]
+                self.__targets[target] = score
 
         self.__freebases = {}
-        if self.__debug_info:
-            if self.__debug_info['fbid']:
-                for i in range(0, len(self.__debug_info['fbid'])):
-                    fbid = self.__debug_info['fbid'][i]
-                    score = self.__debug_info['fbid_score_avg'][i]
-                    self.__freebases[fbid] = score
-        else:
-            query = """
-                SELECT DISTINCT ?fbid {
-                   ?member aida:privateData [
-                        aida:jsonContent ?fbid ;
-                        aida:system <http://www.rpi.edu/EDL_Freebase>
-                    ]
-                }
-            """
+        if self.__debug_info['fbid']:
+            for i in range(0, len(self.__debug_info['fbid'])):
+                fbid = self.__debug_info['fbid'][i]
+                score = self.__debug_info['fbid_score_avg'][i]
+                self.__freebases[fbid] = score
 
-            for j_fbid, in self.model.sparql.query(query, namespaces, {'member': self.uri}):
-                fbids = json.loads(j_fbid).get('freebase_link').keys()
-                for fbid in fbids:
-                    self.__freebases[fbid] = 0
+    def _add_freebases(self, j_fbid):
+        fbids = json.loads(j_fbid).get('freebase_link').keys()
+        for fbid in fbids:
+            self.__freebases[fbid] = 0
 
     def _init_source(self):
         query = """
@@ -875,10 +1425,11 @@ ORDER BY ?start """
         for source, start, end in self.model.sparql.query(query, namespaces, {'member': self.uri}):
             self.__source = str(source)
             self.__context_pos.append((int(start), int(end)))
+        self.__source_loaded = True
 
     @property
     def source(self):
-        if not self.__source:
+        if not self.__source_loaded:
             self._init_source()
         return self.__source
 
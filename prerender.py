@@ -0,0 +1,91 @@
+"""
+Renders the neighbourhood graphs of the largest clusters of a repository or graph ahead of a review session, so
+that their cluster pages find the image cached:
+
+    python prerender.py <repo> [graph] [-n N] [-w workers]
+
+N defaults to setting.prerender_top, workers to the number of cores; every worker builds one graph at a time and
+waits on its own dot process. Build and layout times are written to a .tsv file next to the rendered graphs.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import time
+import sys
+import os
+import re
+import setting
+import render
+from model import get_model
+
+
+def top_clusters(model, n):
+    """
+    The `n` largest clusters of the summary as (uri, size), largest first.
+    """
+    sizes = ((uri, c['size']) for uri, c in model.pickled.items() if 'size' in c)
+    return sorted(sizes, key=lambda e: (-e[1], e[0]))[:n]
+
+
+def report_file(repo, graph):
+    name = repo
+    if graph:
+        name = repo + '-' + re.sub('[^0-9a-zA-Z]+', '-', graph)
+    return os.path.join(setting.render_cache, 'prerender-' + name + '.tsv')
+
+
+def prerender(model, uri):
+    cluster = model.get_cluster(uri)
+    if cluster is None:
+        raise ValueError('%s is not a cluster' % uri)
+    started = time.time()
+    graph = cluster.neighborhood_graph()
+    dot = graph.to_draw()
+    build_seconds = time.time() - started
+    layout_seconds = render.service.render(cluster.graph_name, dot)
+    return len(graph.nodes), len(graph.edges), build_seconds, layout_seconds
+
+
+def run(repo, graph=None, n=None, workers=None, progress=print):
+    """
+    Renders the graphs of the `n` largest clusters in parallel and writes a report of their times.
+    Returns the report rows: rank, cluster, size, nodes, edges, build seconds, layout seconds (empty when the
+    image was cached already) and status.
+    """
+    model = get_model(repo, graph)
+    clusters = top_clusters(model, n or setting.prerender_top)
+    rows = []
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {executor.submit(prerender, model, uri): (rank, uri, size)
+                   for rank, (uri, size) in enumerate(clusters, 1)}
+        for i, future in enumerate(as_completed(futures), 1):
+            rank, uri, size = futures[future]
+            try:
+                nodes, edges, build_seconds, layout_seconds = future.result()
+                layout = '%.2f' % layout_seconds if layout_seconds is not None else ''
+                rows.append([rank, uri, size, nodes, edges, '%.2f' % build_seconds, layout, 'ok'])
+                progress('[%d/%d] %s: %d nodes, %d edges, %s' % (
+                    i, len(futures), uri, nodes, edges,
+                    'laid out in %ss' % layout if layout else 'cached'))
+            except Exception as e:
+                rows.append([rank, uri, size, '', '', '', '', repr(e)])
+                progress('[%d/%d] %s: failed, %r' % (i, len(futures), uri, e))
+
+    rows.sort()
+    with open(report_file(repo, graph), 'w') as f:
+        f.write('rank\tcluster\tsize\tnodes\tedges\tbuild_seconds\tlayout_seconds\tstatus\n')
+        for row in rows:
+            f.write('\t'.join(str(v) for v in row) + '\n')
+    progress('%d graphs in %.1fs, report in %s' % (len(rows), time.time() - started, report_file(repo, graph)))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('repo')
+    parser.add_argument('graph', nargs='?', default='')
+    parser.add_argument('-n', type=int, default=setting.prerender_top)
+    parser.add_argument('-w', '--workers', type=int, default=None)
+    args = parser.parse_args()
+    rows = run(args.repo, args.graph, args.n, args.workers)
+    sys.exit(1 if any(row[-1] != 'ok' for row in rows) else 0)
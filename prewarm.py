@@ -0,0 +1,141 @@
+"""
+Builds or refreshes everything the first request to a repository or graph would otherwise build inline: the
+cluster summaries with their member and adjacency indexes and the debug file indexes, for every repository in
+setting.py (or those given) with its default graph and each of its named graphs.
+
+    python prewarm.py [repo ...]
+
+Graphs are warmed in parallel by setting.prewarm_workers processes. Prewarms of several processes run one after
+another, holding the lock file setting.prewarm_lock.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import threading
+import fcntl
+import time
+import sys
+import os
+import setting
+import store
+import debug
+import groundtruth as gt
+import model
+
+
+def targets(repos=None):
+    for repo in repos or setting.repositories:
+        yield repo, ''
+        for graph in store.list_graphs(repo):
+            yield repo, graph
+
+
+def warm(repo, graph):
+    """
+    Brings the files of one repo/graph up to date, returns what had to be built and the time it took.
+    """
+    start = time.time()
+    built = []
+    if model.build_summaries(store.get_store(repo), repo, graph):
+        built.append('summary')
+    data_file = os.path.realpath(debug.debug_file(repo, graph))
+    if os.path.isfile(data_file) and not debug.index_is_current(data_file):
+        debug.build_index(data_file)
+        built.append('debug index')
+    return built, time.time() - start
+
+
+def lock(block=True):
+    """
+    The prewarm lock file, locked exclusively, or None if another process holds the lock and `block` is false.
+    Closing the file releases the lock.
+    """
+    directory = os.path.dirname(setting.prewarm_lock)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    f = open(setting.prewarm_lock, 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX if block else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+
+def run(repos=None, workers=None, progress=print):
+    """
+    Warms every target in a process pool and reports each one as it finishes, once any prewarm running in
+    another process is done. Returns the failed targets.
+    """
+    with lock():
+        return _run(repos, workers, progress)
+
+
+def _run(repos=None, workers=None, progress=print):
+    todo = list(targets(repos))
+    failed = []
+    # spawned rather than forked: the app starts this from a thread, and a fork would copy its locks and pools
+    # in whatever state the other threads left them
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers or setting.prewarm_workers, mp_context=context) as executor:
+        futures = {executor.submit(warm, repo, graph): (repo, graph) for repo, graph in todo}
+        for i, future in enumerate(as_completed(futures), 1):
+            repo, graph = futures[future]
+            name = '%s %s' % (repo, graph or '(default graph)')
+            try:
+                built, seconds = future.result()
+                progress('[%d/%d] %s: %s in %.1fs' % (i, len(todo), name, ', '.join(built) or 'up to date', seconds))
+            except Exception as e:
+                failed.append((repo, graph))
+                progress('[%d/%d] %s: failed, %r' % (i, len(todo), name, e))
+    return failed
+
+
+def load(repos=None):
+    """
+    Loads the models, debug stores and ground truth indexes of every target into this process.
+    """
+    for repo, graph in targets(repos):
+        try:
+            model.get_model(repo, graph)
+            debug.get_store(repo, graph)
+            gt.get_index(repo, graph)
+        except Exception as e:
+            print('prewarm: loading %s %s failed, %r' % (repo, graph or '(default graph)', e))
+
+
+def start(repos=None):
+    """
+    Warms and loads every target in the background, for the app to call once at startup. Of the processes of
+    a pre-forking server only the first warms, the others load what it built. Does nothing in the worker
+    processes of a prewarm, which import the app's main module again.
+    """
+    if multiprocessing.current_process().name != 'MainProcess':
+        return None
+
+    def warm_all():
+        started = time.time()
+        try:
+            warming = lock(block=False)
+            if warming is None:
+                # another worker of a pre-forking server warms the files, this one waits and only loads them
+                print('prewarm: waiting for the prewarm of another process')
+                lock().close()
+            else:
+                with warming:
+                    _run(repos)
+            load(repos)
+        except Exception as e:
+            print('prewarm failed, %r' % e)
+            return
+        print('prewarm finished in %.1fs' % (time.time() - started))
+
+    thread = threading.Thread(target=warm_all, name='prewarm', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    if any(arg.startswith('-') for arg in sys.argv[1:]):
+        print(__doc__)
+        sys.exit(1)
+    sys.exit(1 if run(sys.argv[1:]) else 0)
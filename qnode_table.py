@@ -0,0 +1,78 @@
+"""
+Imports local freebase -> Wikidata and GeoNames -> Wikidata mappings into key files, so that qnodes can be
+resolved without access to the Wikidata endpoint.
+
+    python qnode_table.py freebase <dump.tsv>   lines of: mid  QID  label  alias1|alias2|...
+    python qnode_table.py geonames <dump.tsv>   lines of: geonames id  QID  label
+"""
+from wikidata import GEONAMES, FREEBASE
+import keyfile
+import json
+import sys
+import os
+import setting
+
+WIKIDATA_ENTITY = 'http://www.wikidata.org/entity/'
+
+
+def normalise_mid(mid):
+    # accepts '/m/0abc' as well as 'm.0abc'
+    if not mid.startswith('/'):
+        mid = '/' + mid.replace('.', '/')
+    return mid
+
+
+def read_dump(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 2 and fields[0] and fields[1]:
+                yield fields + [''] * (4 - len(fields))
+
+
+def freebase_records(path):
+    for mid, qid, label, aliases in read_dump(path):
+        yield normalise_mid(mid), json.dumps({
+            'qid': qid,
+            'url': WIKIDATA_ENTITY + qid,
+            'label': label,
+            'aliases': ', '.join(a for a in aliases.split('|') if a),
+        })
+
+
+def geonames_records(path):
+    for geonames, qid, label, _ in read_dump(path):
+        yield geonames, json.dumps({
+            'qnode': qid,
+            'url': WIKIDATA_ENTITY + qid,
+            'label': label,
+        })
+
+
+tables = {
+    'freebase': (FREEBASE, freebase_records),
+    'geonames': (GEONAMES, geonames_records),
+}
+
+
+def table_file(property_):
+    return setting.freebase_table if property_ == FREEBASE else setting.geonames_table
+
+
+def run(kind, dump):
+    property_, records = tables[kind]
+    path = table_file(property_)
+    if not path:
+        raise ValueError('no file configured for the %s table in setting.py' % kind)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    keyfile.write(path, records(dump), {'property': property_, 'source': os.path.basename(dump)})
+    return path
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in tables:
+        print(__doc__)
+        sys.exit(1)
+    print('Imported', sys.argv[2], 'into', run(sys.argv[1], sys.argv[2]))
@@ -0,0 +1,156 @@
+from collections import OrderedDict
+import threading
+import hashlib
+import sqlite3
+import pickle
+import time
+import os
+import re
+import setting
+
+QUOTED_OR_SPACE = re.compile(r'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')|\s+')
+
+
+def normalise(query):
+    # collapse whitespace outside of string literals so reformatted queries share an entry
+    return QUOTED_OR_SPACE.sub(lambda m: m.group(1) or ' ', query).strip()
+
+
+class DiskTier:
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(os.path.join(directory, 'queries.sqlite'), check_same_thread=False)
+        self.__db.execute('CREATE TABLE IF NOT EXISTS results '
+                          '(id TEXT PRIMARY KEY, repo TEXT, graph TEXT, expires REAL, value BLOB)')
+        self.__db.commit()
+
+    def get(self, id_):
+        with self.__lock:
+            row = self.__db.execute('SELECT expires, value FROM results WHERE id = ?', (id_,)).fetchone()
+        if row and row[0] > time.time():
+            return pickle.loads(row[1])
+        return None
+
+    def put(self, id_, repo, graph, expires, value):
+        with self.__lock:
+            self.__db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                              (id_, repo, graph, expires, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+            self.__db.commit()
+
+    def invalidate(self, repo, graph=None):
+        with self.__lock:
+            if graph is None:
+                self.__db.execute('DELETE FROM results WHERE repo = ?', (repo,))
+            else:
+                self.__db.execute('DELETE FROM results WHERE repo = ? AND graph = ?', (repo, graph))
+            self.__db.execute('DELETE FROM results WHERE expires <= ?', (time.time(),))
+            self.__db.commit()
+
+
+class QueryCache:
+    """
+    Size bounded LRU of query results with a time to live and an optional sqlite tier on disk.
+    Keys are (repo, graph, normalised query, prefixes, bindings).
+    """
+    def __init__(self, size, ttl, directory=None):
+        self.size = size
+        self.ttl = ttl
+        self.disk = DiskTier(directory) if directory else None
+        self.__entries = OrderedDict()  # key to (expires, rows)
+        self.__lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def key(repo, graph, query, initNs=None, initBindings=None):
+        prefixes = tuple(sorted((k, str(v)) for k, v in (initNs or {}).items()))
+        bindings = tuple(sorted((k, v.n3()) for k, v in (initBindings or {}).items()))
+        return repo, graph or '', normalise(query), prefixes, bindings
+
+    @staticmethod
+    def _id(key):
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry:
+                if entry[0] > now:
+                    self.__entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self.__entries[key]
+        if self.disk:
+            rows = self.disk.get(self._id(key))
+            if rows is not None:
+                self._remember(key, rows, now + self.ttl)
+                with self.__lock:
+                    self.disk_hits += 1
+                return rows
+        with self.__lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, rows):
+        expires = time.time() + self.ttl
+        self._remember(key, rows, expires)
+        if self.disk:
+            self.disk.put(self._id(key), key[0], key[1], expires, rows)
+
+    def _remember(self, key, rows, expires):
+        with self.__lock:
+            self.__entries[key] = (expires, rows)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.size:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, repo, graph=None):
+        with self.__lock:
+            for key in [k for k in self.__entries if k[0] == repo and (graph is None or k[1] == (graph or ''))]:
+                del self.__entries[key]
+        if self.disk:
+            self.disk.invalidate(repo, None if graph is None else graph or '')
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'entries': len(self.__entries),
+            'size': self.size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': (self.hits + self.disk_hits) / lookups if lookups else 0,
+        }
+
+
+cache = QueryCache(setting.query_cache_size, setting.query_cache_ttl, setting.query_cache_dir)
+
+
+class CachedStore:
+    """
+    Wraps a store so that query results of one (repo, graph) are served from the shared cache.
+    """
+    def __init__(self, store, repo, graph, cache=cache):
+        self.store = store
+        self.repo = repo
+        self.graph = graph
+        self.cache = cache
+
+    def query(self, query, initNs=None, initBindings=None):
+        key = self.cache.key(self.repo, self.graph, query, initNs, initBindings)
+        rows = self.cache.get(key)
+        if rows is None:
+            rows = self.store.query(query, initNs, initBindings)
+            self.cache.put(key, rows)
+        return rows
+
+    def query_stream(self, query, initNs=None, initBindings=None):
+        # streamed results are read once, typically whole-graph scans, and are not cached
+        return self.store.query_stream(query, initNs, initBindings)
+
+    def invalidate(self):
+        self.cache.invalidate(self.repo, self.graph)
@@ -0,0 +1,191 @@
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import PIPE
+import subprocess
+import threading
+import hashlib
+import gzip
+import time
+import os
+import setting
+
+READY = 'ready'
+PENDING = 'pending'
+FAILED = 'failed'
+MISSING = 'missing'
+
+SVG = 'SVG'
+LAYOUT = ['-Ksfdp', '-Goverlap=prism', '-Goverlap_scaling=5', '-Gsep=+20']
+
+
+def layout(dot, format=SVG, options=LAYOUT):
+    """
+    Lays out the DOT text `dot`, passed to Graphviz on stdin, and returns the image.
+    """
+    res = subprocess.run(['dot', '-T' + format.lower()] + options, input=dot.encode('utf-8'),
+                         stdout=PIPE, stderr=PIPE)
+    if res.returncode:
+        raise RuntimeError('dot exited with %d: %s' % (res.returncode, res.stderr.decode('utf-8', 'replace')))
+    return res.stdout
+
+
+class RenderCache:
+    """
+    Rendered graphs kept gzip compressed under the sha256 of their DOT text and layout options, so that a graph
+    is laid out again only when its content changes. Once the files take more than `quota` bytes the least
+    recently served ones are removed.
+    """
+    def __init__(self, directory, quota):
+        self.directory = directory
+        self.quota = quota
+        self.__lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'names'), exist_ok=True)
+
+    @staticmethod
+    def key(dot, options=LAYOUT):
+        return hashlib.sha256((' '.join(options) + '\n' + dot).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.svg.gz')
+
+    def has(self, key):
+        return os.path.isfile(self.path(key))
+
+    def get(self, key):
+        """
+        The compressed image, None if it is not cached.
+        """
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            # the modification time records the last use
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, key, image):
+        path = self.path(key)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(gzip.compress(image))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        with self.__lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.svg.gz'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            # the most recent image is always kept
+            for _, size, path in entries[:-1]:
+                if total <= self.quota:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def name_key(self, name):
+        try:
+            with open(os.path.join(self.directory, 'names', name)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def set_name_key(self, name, key):
+        path = os.path.join(self.directory, 'names', name)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            f.write(key)
+        os.replace(tmp_path, path)
+
+
+class RenderService:
+    """
+    Renders cluster graphs with Graphviz in the background. Every worker thread waits on one `dot` process, so
+    at most `workers` layouts run at a time, and a graph that is already being rendered is not queued again.
+    A graph is looked up by name; the image last rendered for a name is served while the graph is checked for
+    changes, at most every `recheck` seconds.
+    """
+    def __init__(self, cache, workers, recheck=300):
+        self.cache = cache
+        self.recheck = recheck
+        self.__executor = ThreadPoolExecutor(max_workers=workers)
+        self.__pending = {}  # name to the Future of its rendering
+        self.__failed = {}  # name to the error of its last rendering
+        self.__checked = {}  # name to the time its graph was last compared with the cache
+        self.__lock = threading.Lock()
+
+    def submit(self, name, build):
+        """
+        Queues the rendering of the graph returned by `build` unless it is queued or was checked recently.
+        `build` runs in the worker, so not even the neighbourhood of the graph is computed by the caller.
+        """
+        with self.__lock:
+            if name in self.__pending:
+                return
+            key = self.cache.name_key(name)
+            if key and self.cache.has(key) and time.time() - self.__checked.get(name, 0) < self.recheck:
+                return
+            self.__failed.pop(name, None)
+            future = self.__pending[name] = self.__executor.submit(self._render, name, build)
+        future.add_done_callback(lambda f: self._done(name, f))
+
+    def render(self, name, dot):
+        """
+        Makes the image of the DOT text `dot` the one served for `name`, laying it out unless it is cached.
+        Returns the seconds the layout took, None for a cached image.
+        """
+        key = self.cache.key(dot)
+        seconds = None
+        if not self.cache.has(key):
+            started = time.time()
+            self.cache.put(key, layout(dot))
+            seconds = time.time() - started
+        self.cache.set_name_key(name, key)
+        return seconds
+
+    def _render(self, name, build):
+        self.render(name, build().to_draw())
+
+    def _done(self, name, future):
+        with self.__lock:
+            del self.__pending[name]
+            self.__checked[name] = time.time()
+            if future.exception() is not None:
+                self.__failed[name] = repr(future.exception())
+                print('rendering', name, 'failed:', self.__failed[name])
+
+    def get(self, name):
+        """
+        (key, compressed image) last rendered for `name`, None if there is none.
+        """
+        key = self.cache.name_key(name)
+        data = self.cache.get(key) if key else None
+        return (key, data) if data is not None else None
+
+    def status(self, name):
+        with self.__lock:
+            key = self.cache.name_key(name)
+            if key and self.cache.has(key):
+                return READY
+            if name in self.__pending:
+                return PENDING
+            if name in self.__failed:
+                return FAILED
+            return MISSING
+
+    def error(self, name):
+        return self.__failed.get(name)
+
+
+service = RenderService(RenderCache(setting.render_cache, setting.render_cache_mb * 1024 * 1024),
+                        setting.render_workers, setting.render_recheck_interval)
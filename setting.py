@@ -11,9 +11,74 @@ password = 'gaia@isi'
 # url_prefix = "/viz"
 url_prefix = ""
 
+# ground truth service for external clients, cluster pages use the ground truth in process
 # deploy
 groundtruth_url = 'http://gaiadev01.isi.edu:' + port + '/groundtruth'
 
 # testing
 # groundtruth_url = 'http://127.0.0.1:' + port + '/groundtruth'
 
+
+# SPARQL connection pool, shared by all repositories of a worker process
+sparql_pool_size = 10
+sparql_pool_block = True  # wait for a free connection instead of opening extra ones
+sparql_keep_alive = True
+sparql_connect_timeout = 5  # seconds
+sparql_read_timeout = 300  # seconds
+
+# memory budget of the loaded cluster summaries kept per (repo, graph)
+model_cache_mb = 2048
+
+# SPARQL result cache
+query_cache_size = 20000  # number of cached results kept in memory
+query_cache_ttl = 3600  # seconds
+query_cache_dir = None  # e.g. 'cache' to also keep results on disk
+
+# seconds between checks of a loaded graph for changes, changed clusters are summarised again
+summary_check_interval = 600
+summary_workers = 4  # summary queries run concurrently
+summary_partitions = 1  # 16 or 256 split each summary query by cluster URI hash for very large graphs
+
+# prewarm.py builds the summaries and indexes of all repositories and graphs ahead of the first request
+prewarm_workers = 4  # processes
+prewarm_on_startup = False  # also prewarm in the background whenever the app starts
+prewarm_lock = 'cache/prewarm.lock'  # held by the process warming, the others wait for it and only load
+
+# cluster pages load their independent parts concurrently before rendering
+prefetch_workers = 16
+prefetch_deadline = 30  # seconds
+
+# neighbourhood graphs stop growing beyond these sizes
+neighborhood_max_nodes = 300
+neighborhood_max_edges = 1000
+
+# cluster graphs are laid out by at most this many concurrent dot processes
+render_workers = 4
+render_cache = 'cache/render'  # rendered graphs, stored compressed under the hash of their content
+render_cache_mb = 512
+render_recheck_interval = 300  # seconds before the graph of a cluster page is compared with its image again
+prerender_top = 100  # clusters rendered by prerender.py, largest first
+
+# keep the super-edge graph of each (repo, graph) in memory instead of querying it per cluster
+precompute_adjacency = True
+
+# Wikidata lookups of GeoNames targets and freebase ids
+wikidata_cache = 'cache/wikidata.sqlite'  # None keeps lookups in memory only
+wikidata_cache_ttl = 30 * 24 * 3600  # seconds
+wikidata_negative_ttl = 24 * 3600  # seconds, for ids without a Wikidata entity
+wikidata_batch_size = 200  # ids bound per VALUES clause
+
+# local mapping tables imported with qnode_table.py, looked up before the Wikidata endpoint
+freebase_table = 'tables/freebase.keys'
+geonames_table = 'tables/geonames.keys'
+wikidata_network_fallback = True  # False never queries wikidata_endpoint
+
+# segments of recently used LTF source documents kept in memory for mention contexts
+source_context_cache_mb = 256
+
+# parsed debug records kept per debug file
+debug_cache_records = 256
+
+# uploaded debug and ground truth files are ingested in the background
+upload_data = 'uploads'
+ingest_workers = 2
@@ -1,5 +1,91 @@
 from pathlib import Path
+from collections import OrderedDict, defaultdict
+from bisect import bisect_left, bisect_right
+from array import array
 import xml.etree.ElementTree as ET
+import threading
+import sys
+import os
+import setting
+
+
+class SegmentIndex:
+    """
+    Segments of one LTF document, parsed once, as arrays of their start and end offsets and their texts in
+    document order. The segments overlapping a span are found by binary search.
+    """
+    def __init__(self, starts, ends, texts, mtime=None):
+        self.starts = starts
+        self.ends = ends
+        self.texts = texts
+        self.mtime = mtime
+        self.size = sum(sys.getsizeof(t) for t in texts) + starts.itemsize * len(starts) * 2
+
+    @classmethod
+    def parse(cls, filepath):
+        starts, ends, texts = array('q'), array('q'), []
+        mtime = os.path.getmtime(filepath)
+        root = ET.parse(filepath).getroot()
+        for child in root.findall('./DOC/TEXT/SEG'):
+            starts.append(int(child.get('start_char')))
+            ends.append(int(child.get('end_char')))
+            texts.append(child.find('ORIGINAL_TEXT').text or '')
+        return cls(starts, ends, texts, mtime)
+
+    def query(self, start, end):
+        # segments ending at or after start up to the last one starting at or before end
+        first = bisect_left(self.ends, start)
+        last = bisect_right(self.starts, end)
+        return ' '.join(self.texts[first:last])
+
+
+class SegmentCache:
+    """
+    LRU of the segment indexes of recently used documents, bounded by their approximate size in memory.
+    A document is parsed again once its file changed.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.__indexes = OrderedDict()  # file path to SegmentIndex
+        self.__lock = threading.Lock()
+        self.__loading = defaultdict(threading.Lock)
+
+    def get(self, filepath):
+        filepath = str(filepath)
+        index = self._lookup(filepath)
+        if index:
+            return index
+        with self.__loading[filepath]:
+            index = self._lookup(filepath)
+            if not index:
+                index = SegmentIndex.parse(filepath)
+                self._add(filepath, index)
+        return index
+
+    def _lookup(self, filepath):
+        with self.__lock:
+            index = self.__indexes.get(filepath)
+            if index is None:
+                return None
+            if index.mtime != os.path.getmtime(filepath):
+                self.size -= self.__indexes.pop(filepath).size
+                return None
+            self.__indexes.move_to_end(filepath)
+            return index
+
+    def _add(self, filepath, index):
+        with self.__lock:
+            if filepath in self.__indexes:
+                self.size -= self.__indexes.pop(filepath).size
+            self.__indexes[filepath] = index
+            self.size += index.size
+            while len(self.__indexes) > 1 and self.size > self.budget:
+                _, evicted = self.__indexes.popitem(last=False)
+                self.size -= evicted.size
+
+
+segments = SegmentCache(setting.source_context_cache_mb * 1024 * 1024)
 
 
 class SourceContext:
@@ -32,18 +118,7 @@ class LTFSourceContext(SourceContext):
         self.filepath = self.source_path / (doc_id + '.ltf.xml')
 
     def query_context(self, start, end):
-        tree = ET.parse(self.filepath)
-        root = tree.getroot()
-        texts = []
-        for child in root.findall('./DOC/TEXT/SEG'):
-            seg_start, seg_end = int(child.get('start_char')), int(child.get('end_char'))
-            if seg_end < start:
-                continue
-            if seg_start > end:
-                break
-            text = child.find('ORIGINAL_TEXT').text
-            texts.append(text)
-        return ' '.join(texts)
+        return segments.get(self.filepath).query(start, end)
 
 
 class TextSourceContext(SourceContext):
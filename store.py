@@ -0,0 +1,265 @@
+from rdflib import URIRef, Literal, BNode
+from rdflib.namespace import XSD
+from requests.adapters import HTTPAdapter
+from collections import namedtuple
+from contextlib import closing
+from functools import lru_cache
+import requests
+import threading
+import setting
+import re
+import os
+
+SPARQL_JSON = 'application/sparql-results+json'
+SPARQL_TSV = 'text/tab-separated-values'
+
+
+class ConnectionPool:
+    """
+    One keep-alive HTTP session per process shared by every SPARQL store.
+    The session is rebuilt after a fork so pre-forking servers never share sockets between workers.
+    """
+    def __init__(self, size, block=True, keep_alive=True, timeout=None):
+        self.size = size
+        self.block = block
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.__lock = threading.Lock()
+        self.__session = None
+        self.__adapter = None
+        self.__pid = None
+        self.__in_flight = 0
+        self.__peak = 0
+        self.__requests = 0
+        self.__errors = 0
+
+    @property
+    def session(self):
+        if self.__pid != os.getpid():
+            with self.__lock:
+                if self.__pid != os.getpid():
+                    self._reset()
+        return self.__session
+
+    def _reset(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.size, pool_maxsize=self.size, pool_block=self.block)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        self.__session = session
+        self.__adapter = adapter
+        self.__pid = os.getpid()
+        self.__in_flight = self.__peak = self.__requests = self.__errors = 0
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        session = self.session
+        with self.__lock:
+            self.__in_flight += 1
+            self.__requests += 1
+            self.__peak = max(self.__peak, self.__in_flight)
+        try:
+            res = session.request(method, url, **kwargs)
+            res.raise_for_status()
+            return res
+        except requests.RequestException:
+            with self.__lock:
+                self.__errors += 1
+            raise
+        finally:
+            with self.__lock:
+                self.__in_flight -= 1
+
+    def stats(self):
+        hosts = {}
+        if self.__adapter:
+            pools = self.__adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                hosts['%s://%s:%s' % (pool.scheme, pool.host, pool.port)] = {
+                    'opened': pool.num_connections,
+                    'idle': pool.pool.qsize() if pool.pool else 0,
+                    'requests': pool.num_requests,
+                }
+        return {
+            'pid': self.__pid,
+            'size': self.size,
+            'in_flight': self.__in_flight,
+            'peak_in_flight': self.__peak,
+            'utilisation': self.__in_flight / self.size if self.size else 0,
+            'requests': self.__requests,
+            'errors': self.__errors,
+            'hosts': hosts,
+        }
+
+
+pool = ConnectionPool(setting.sparql_pool_size,
+                      block=setting.sparql_pool_block,
+                      keep_alive=setting.sparql_keep_alive,
+                      timeout=(setting.sparql_connect_timeout, setting.sparql_read_timeout))
+
+
+@lru_cache(maxsize=256)
+def _row_type(vars_):
+    return namedtuple('Row', vars_, rename=True)
+
+
+class Rows(list):
+    """
+    Materialised query result. Iterating a SELECT result yields tuples that also allow
+    access by variable name (row.cluster), iterating an ASK result yields its single boolean.
+    """
+    def __init__(self, vars_=(), rows=()):
+        super().__init__(rows)
+        self.vars = tuple(vars_)
+
+    def __iter__(self):
+        if not self.vars:
+            return super().__iter__()
+        row = _row_type(self.vars)
+        return (row(*r) for r in super().__iter__())
+
+    def __reduce__(self):
+        return Rows, (self.vars, list(super().__iter__()))
+
+    @classmethod
+    def from_json(cls, result):
+        if 'boolean' in result:
+            return cls((), [result['boolean']])
+        vars_ = result['head']['vars']
+        return cls(vars_, [tuple(to_term(b.get(v)) for v in vars_) for b in result['results']['bindings']])
+
+
+def to_term(binding):
+    if binding is None:
+        return None
+    type_ = binding['type']
+    if type_ == 'uri':
+        return URIRef(binding['value'])
+    if type_ == 'bnode':
+        return BNode(binding['value'])
+    return Literal(binding['value'], lang=binding.get('xml:lang'), datatype=binding.get('datatype'))
+
+
+TSV_LITERAL = re.compile(r'"(.*)"(?:@([a-zA-Z0-9-]+)|\^\^<(.*)>)?$', re.S)
+TSV_INTEGER = re.compile(r'[+-]?[0-9]+$')
+TSV_ESCAPE = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+escapes = {'t': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f'}
+
+
+def unescape(match):
+    code = match.group(1) or match.group(2)
+    if code:
+        return chr(int(code, 16))
+    return escapes.get(match.group(3), match.group(3))
+
+
+def from_tsv(value):
+    """
+    Term of one field of a SPARQL TSV result, None for an unbound variable.
+    """
+    if not value:
+        return None
+    if value[0] == '<':
+        return URIRef(value[1:-1])
+    if value.startswith('_:'):
+        return BNode(value[2:])
+    m = TSV_LITERAL.match(value)
+    if m:
+        return Literal(TSV_ESCAPE.sub(unescape, m.group(1)), lang=m.group(2), datatype=m.group(3))
+    # numbers and booleans are written without quotes
+    if value in ('true', 'false'):
+        return Literal(value, datatype=XSD.boolean)
+    if TSV_INTEGER.match(value):
+        return Literal(value, datatype=XSD.integer)
+    if 'e' in value or 'E' in value:
+        return Literal(value, datatype=XSD.double)
+    return Literal(value, datatype=XSD.decimal)
+
+
+def prepare_query(query, initNs=None, initBindings=None):
+    if initNs:
+        prefixes = ''.join('PREFIX %s: <%s>\n' % (k, v) for k, v in initNs.items())
+        query = prefixes + query
+    if initBindings:
+        vars_ = ' '.join('?' + k for k in initBindings)
+        values = ' '.join(v.n3() for v in initBindings.values())
+        query += '\nVALUES ( %s )\n{ ( %s ) }\n' % (vars_, values)
+    return query
+
+
+class Store:
+    """
+    Drop-in replacement for rdflib's SPARQLStore.query that goes through the shared connection pool.
+    """
+    def __init__(self, endpoint, auth=None):
+        self.endpoint = endpoint
+        self.auth = auth
+
+    def query(self, query, initNs=None, initBindings=None):
+        res = pool.request('POST', self.endpoint,
+                           data={'query': prepare_query(query, initNs, initBindings)},
+                           headers={'Accept': SPARQL_JSON},
+                           auth=self.auth)
+        return Rows.from_json(res.json())
+
+    def query_stream(self, query, initNs=None, initBindings=None):
+        """
+        Same rows as query, parsed one by one from a tab separated result while it is being received,
+        so that large results are never held in memory as a whole.
+        """
+        res = pool.request('POST', self.endpoint,
+                           data={'query': prepare_query(query, initNs, initBindings)},
+                           headers={'Accept': SPARQL_TSV},
+                           auth=self.auth,
+                           stream=True)
+        with closing(res):
+            # split on newlines only, literals may contain other line separators unescaped
+            lines = res.iter_lines(delimiter=b'\n')
+            header = next(lines, b'').decode('utf-8').rstrip('\r')
+            row = _row_type(tuple(var[1:] for var in header.split('\t')))
+            for line in lines:
+                line = line.decode('utf-8').rstrip('\r')
+                if line:
+                    yield row(*(from_tsv(field) for field in line.split('\t')))
+
+    def size(self, context=None):
+        """
+        Number of statements in the repository, or in the named graph `context`.
+        """
+        params = {'context': URIRef(context).n3()} if context else None
+        res = pool.request('GET', self.endpoint + '/size', params=params, auth=self.auth)
+        return int(res.text)
+
+
+stores = {}  # endpoint to its Store
+stores_lock = threading.Lock()
+
+
+def get_endpoint_store(endpoint, auth=None):
+    if endpoint not in stores:
+        with stores_lock:
+            if endpoint not in stores:
+                stores[endpoint] = Store(endpoint, auth)
+    return stores[endpoint]
+
+
+def get_store(repo):
+    return get_endpoint_store(setting.endpoint + '/' + repo, (setting.username, setting.password))
+
+
+def list_graphs(repo):
+    res = pool.request('GET', setting.endpoint + '/' + repo + '/rdf-graphs',
+                       headers={'Accept': SPARQL_JSON},
+                       auth=(setting.username, setting.password))
+    return [r['contextID']['value'] for r in res.json()['results']['bindings']]
+
+
+def pool_stats():
+    stats = pool.stats()
+    stats['stores'] = list(stores.keys())
+    return stats
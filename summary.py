@@ -0,0 +1,110 @@
+from collections import defaultdict
+import tempfile
+import pickle
+import time
+import os
+import tmp
+import time_person_label
+
+SCHEMA = 'gaia-summary'
+VERSION = 1
+REBUILD_RATIO = 0.5  # share of changed clusters above which everything is described again
+
+
+class Summary:
+    """
+    Cluster summary of a graph, {cluster: {'size', 'digest', 'label', 'type', 'class'}}, with the schema version
+    it was written with and the fingerprint of the graph it was built from. Pickles written before the store
+    existed load as version 0 without fingerprint.
+    """
+    def __init__(self, clusters, fingerprint=None, version=VERSION, built=None):
+        self.clusters = clusters
+        self.fingerprint = fingerprint
+        self.version = version
+        self.built = built or time.time()
+
+    def is_current(self, fingerprint):
+        return self.version == VERSION and self.fingerprint == fingerprint
+
+
+def load(file_path):
+    with open(file_path, 'rb') as f:
+        data = pickle.load(f)
+    if isinstance(data, dict) and data.get('schema') == SCHEMA:
+        return Summary(data['clusters'], data['fingerprint'], data['version'], data['built'])
+    return Summary(dict(data), version=0)
+
+
+def write(file_path, summary):
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # a temporary file of its own, several processes may write the same summary at once
+    fd, tmp_path = tempfile.mkstemp(dir=directory or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({
+                'schema': SCHEMA,
+                'version': summary.version,
+                'fingerprint': summary.fingerprint,
+                'built': summary.built,
+                'clusters': dict(summary.clusters),
+            }, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def fingerprint(sparql, graph):
+    return {'statements': sparql.size(graph)}
+
+
+def refresh(sparql, graph, file_path, namespaces, AIDA):
+    """
+    The summary of the graph brought up to date from the one at `file_path`, None if that one is current.
+    A missing summary is built, an existing one only re-describes the clusters that appeared or whose members
+    changed since it was written. Writing it is left to the caller, which writes the indexes derived from the
+    graph first.
+    """
+    # taken before reading the graph, so changes made during a refresh are picked up by the next one
+    stamp = fingerprint(sparql, graph)
+    current = load(file_path) if os.path.isfile(file_path) else None
+    if current and current.is_current(stamp):
+        return None
+    if current is None or current.version > VERSION:
+        clusters = build(sparql, graph, namespaces, AIDA)
+    else:
+        clusters = update(sparql, graph, current, namespaces, AIDA)
+    return Summary(clusters, stamp)
+
+
+def build(sparql, graph, namespaces, AIDA):
+    data = tmp.run(sparql, graph, namespaces, AIDA)
+    time_person_label.run(sparql, graph, data, namespaces)
+    return data
+
+
+def update(sparql, graph, current, namespaces, AIDA):
+    sizes = tmp.cluster_sizes(sparql, graph, namespaces)
+    clusters = current.clusters
+    # pickles from before the store lack the member digest and the prototype class, all their clusters are
+    # described again
+    changed = [uri for uri, values in sizes.items()
+               if uri not in clusters or clusters[uri].get('digest') != values['digest']
+               or clusters[uri].get('size') != values['size']]
+
+    if len(changed) > len(sizes) * REBUILD_RATIO:
+        data = defaultdict(dict, ((uri, dict(values)) for uri, values in sizes.items()))
+        tmp.describe(sparql, graph, namespaces, AIDA, data)
+        time_person_label.run(sparql, graph, data, namespaces)
+        return data
+
+    data = tmp.run(sparql, graph, namespaces, AIDA, changed)
+    time_person_label.run(sparql, graph, data, namespaces)
+    changed = set(changed)
+    # clusters gone from the graph are dropped
+    result = {uri: clusters[uri] for uri in sizes if uri not in changed}
+    for uri in changed:
+        result[uri] = dict(data.get(uri, {}), **sizes[uri])
+    return result
@@ -1,50 +1,60 @@
 from rdflib import URIRef
-import pickle
 
-
-def run(sparql, graph, file_path, namespaces):
-    pickled = pickle.load(open(file_path, 'rb'))
+SEEDLING = 'https://tac.nist.gov/tracks/SM-KBP/2019/ontologies/SeedlingOntology#'
+prefixes = {
+    'Person': '[P]',
+    'Time': '[T]',
+    'Facility': '[F]',
+    'Money': '[M]',
+    'Location': '[L]',
+    'Weapon': '[W]',
+    'Organization': '[O]',
+    'Vehicle': '[V]',
+}
+BATCH_SIZE = 1000  # clusters bound per VALUES clause
+
+
+def run(sparql, graph, pickled, namespaces, clusters=None):
+    """
+    Names the clusters of the summary `pickled` that are only labelled by their type, all of them or those in
+    `clusters`, after the most frequent justification label of their members.
+    """
 
     open_clause = close_clause = ''
     if graph:
         open_clause = 'GRAPH <%s> {' % graph
         close_clause = '}'
 
+    unnamed = {}  # cluster to the prefix of its type
+    for uri, cluster in pickled.items():
+        if clusters is not None and uri not in clusters:
+            continue
+        typ = cluster.get('label')
+        if typ in prefixes and cluster.get('type') == SEEDLING + typ:
+            unnamed[uri] = prefixes[typ]
 
-    def query_justification_lbl(uri):
+    def query_justification_lbls(uris):
         query = """
-        SELECT ?lbl 
+        SELECT ?cluster ?lbl (COUNT(?lbl) AS ?cnt)
         WHERE {
             %s
+            VALUES ?cluster { %s }
             ?ms aida:cluster ?cluster ;
                 aida:clusterMember/aida:justifiedBy/skos:prefLabel ?lbl .
             %s
         }
-        GROUP BY ?lbl
-        ORDER BY DESC(COUNT(?lbl))
-        LIMIT 1
-        """ % (open_clause, close_clause)
-        for lbl, in sparql.query(query, namespaces, {'cluster': URIRef(uri)}):
-            return lbl
-
-
-    def query_justification_label_for_cluster_by_type(typ, prefix=''):
-        for uri, cluster in pickled.items():
-            if cluster['label'] == typ and cluster['type'] == 'https://tac.nist.gov/tracks/SM-KBP/2019/ontologies/SeedlingOntology#' + typ:
-                label = query_justification_lbl(uri)
-                if label:
-                    cluster['label'] = prefix + label
-
-
-    query_justification_label_for_cluster_by_type('Person', '[P]')
-    query_justification_label_for_cluster_by_type('Time', '[T]')
-    query_justification_label_for_cluster_by_type('Facility', '[F]')
-    query_justification_label_for_cluster_by_type('Money', '[M]')
-    query_justification_label_for_cluster_by_type('Location', '[L]')
-    query_justification_label_for_cluster_by_type('Weapon', '[W]')
-    query_justification_label_for_cluster_by_type('Organization', '[O]')
-    query_justification_label_for_cluster_by_type('Vehicle', '[V]')
-
-
-    pickle.dump(pickled, open(file_path, 'wb'))
-
+        GROUP BY ?cluster ?lbl
+        """ % (open_clause, ' '.join(URIRef(uri).n3() for uri in uris), close_clause)
+        best = {}
+        for cluster, lbl, cnt in sparql.query_stream(query, namespaces):
+            cluster, cnt = str(cluster), int(cnt)
+            # most frequent label, ties go to the first label in order
+            if cluster not in best or (-cnt, str(lbl)) < (-best[cluster][1], str(best[cluster][0])):
+                best[cluster] = (lbl, cnt)
+        return best
+
+    uris = list(unnamed)
+    for i in range(0, len(uris), BATCH_SIZE):
+        for uri, (label, _) in query_justification_lbls(uris[i:i+BATCH_SIZE]).items():
+            if label:
+                pickled[uri]['label'] = unnamed[uri] + str(label)
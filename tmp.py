@@ -1,33 +1,73 @@
+from rdflib import URIRef
 from rdflib.namespace import split_uri
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
 import pickle
+import setting
+import os
 
+BATCH_SIZE = 500  # clusters bound per VALUES clause when only some clusters are summarised
+DIGEST_DIGITS = 12  # hex digits of the MD5 of each member summed into the digest of its cluster
 
-def run(sparql, graph, file_path, namespaces, AIDA):
 
-    data = defaultdict(dict)
-
-    open_clause = close_clause = ''
+def graph_clauses(graph):
     if graph:
-        open_clause = 'GRAPH <%s> {' % graph
-        close_clause = '}'
+        return 'GRAPH <%s> {' % graph, '}'
+    return '', ''
 
-    query = """
-    SELECT ?cluster (COUNT(?member) AS ?size)
+
+def partitions(n):
+    """
+    Filters splitting the clusters of a graph into about `n` parts by the first hex digits of the MD5 of their
+    URI, a single unfiltered part for n <= 1.
+    """
+    digits = 0
+    while 16 ** digits < n:
+        digits += 1
+    if not digits:
+        return ['']
+    return ['FILTER(STRSTARTS(MD5(STR(?cluster)), "%0*x"))' % (digits, i) for i in range(16 ** digits)]
+
+
+def restrictions(clusters=None):
+    if clusters is None:
+        return partitions(setting.summary_partitions)
+    clusters = list(clusters)
+    return ['VALUES ?cluster { %s }' % ' '.join(URIRef(c).n3() for c in clusters[i:i+BATCH_SIZE])
+            for i in range(0, len(clusters), BATCH_SIZE)]
+
+
+def member_digest(var):
+    """
+    SPARQL expression of the integer value of the first DIGEST_DIGITS hex digits of `var`, an MD5. SPARQL
+    cannot read hex, each digit is valued by its position in "0123456789abcdef".
+    """
+    digit = 'STRLEN(STRBEFORE("0123456789abcdef", SUBSTR(%s, %%d, 1)))' % var
+    return ' + '.join('%d * %s' % (16 ** (DIGEST_DIGITS - i), digit % i) for i in range(1, DIGEST_DIGITS + 1))
+
+
+def sizes_query(open_clause, close_clause):
+    # the digest sums the hashes of the members, so it is computed by the store whatever the order of the rows
+    # and changes when a member is swapped for another
+    return """
+    SELECT ?cluster (COUNT(?member) AS ?size) (SUM(%s) AS ?digest)
     WHERE {
         %s
             ?membership aida:cluster ?cluster ;
                         aida:clusterMember ?member .
+            BIND(MD5(STR(?member)) AS ?hash)
         %s
     }
-    GROUP BY ?cluster """ % (open_clause, close_clause)
+    GROUP BY ?cluster """ % (member_digest('?hash'), open_clause, close_clause)
 
-    for cluster, size in sparql.query(query, namespaces):
-        cluster = str(cluster)
-        data[cluster]['size'] = int(size)
 
-    # Entity
-    query = """
+def read_sizes(rows, AIDA):
+    return {str(cluster): {'size': int(size), 'digest': int(digest)} for cluster, size, digest in rows}
+
+
+def entities_query(open_clause, close_clause):
+    return """
     SELECT ?cluster ?label ?category
     WHERE {
         %s
@@ -40,15 +80,21 @@ def run(sparql, graph, file_path, namespaces, AIDA):
          %s
     } """ % (open_clause, close_clause)
 
-    for cluster, label, type_ in sparql.query(query, namespaces):
+
+def read_entities(rows, AIDA):
+    data = defaultdict(dict)
+    for cluster, label, type_ in rows:
         if not label and type_:
             _, label = split_uri(type_)
         cluster = str(cluster)
         data[cluster]['label'] = str(label) if label else cluster
         data[cluster]['type'] = str(type_)
+        data[cluster]['class'] = str(AIDA.Entity)
+    return data
 
-    # Event
-    query = """
+
+def events_query(open_clause, close_clause):
+    return """
     SELECT ?cluster ?category
     WHERE {
         %s
@@ -60,14 +106,20 @@ def run(sparql, graph, file_path, namespaces, AIDA):
         %s
     } """ % (open_clause, close_clause)
 
-    for cluster, type_ in sparql.query(query, namespaces):
+
+def read_events(rows, AIDA):
+    data = defaultdict(dict)
+    for cluster, type_ in rows:
         _, label = split_uri(type_)
         cluster = str(cluster)
         data[cluster]['label'] = str(label)
         data[cluster]['type'] = str(type_)
+        data[cluster]['class'] = str(AIDA.Event)
+    return data
 
-    # Relation
-    query = """
+
+def relations_query(open_clause, close_clause):
+    return """
     SELECT ?cluster ?type
     WHERE {
         %s
@@ -79,11 +131,91 @@ def run(sparql, graph, file_path, namespaces, AIDA):
         %s
     } """ % (open_clause, close_clause)
 
-    for cluster, type_ in sparql.query(query, namespaces):
+
+def read_relations(rows, AIDA):
+    data = defaultdict(dict)
+    for cluster, type_ in rows:
         _, label = split_uri(type_)
         cluster = str(cluster)
         data[cluster]['label'] = str(label)
         data[cluster]['type'] = str(AIDA.Relation)
+        data[cluster]['class'] = str(AIDA.Relation)
+    return data
+
+
+SIZES = [(sizes_query, read_sizes)]
+DESCRIPTIONS = [(entities_query, read_entities), (events_query, read_events), (relations_query, read_relations)]
+
+
+def collect(sparql, graph, namespaces, AIDA, parts, clusters=None, data=None):
+    """
+    Runs every (query, reader) of `parts` once per restriction of the clusters, all concurrently, and merges
+    what the readers make of the streamed rows into `data`.
+    """
+    open_clause, close_clause = graph_clauses(graph)
+    tasks = [(query(open_clause + '\n            ' + restriction, close_clause), read)
+             for query, read in parts for restriction in restrictions(clusters)]
+    if data is None:
+        data = defaultdict(dict)
+
+    def fetch(query, read):
+        return read(sparql.query_stream(query, namespaces), AIDA)
+
+    with ThreadPoolExecutor(max_workers=setting.summary_workers) as executor:
+        futures = [executor.submit(fetch, query, read) for query, read in tasks]
+        # merged in submission order, so later queries win exactly as when they ran one after another
+        for future in futures:
+            for cluster, values in future.result().items():
+                data.setdefault(cluster, {}).update(values)
+    return data
+
+
+def cluster_sizes(sparql, graph, namespaces):
+    """
+    {cluster: {'size', 'digest'}} of every cluster of the graph, the prototype counted as a member.
+    """
+    return collect(sparql, graph, namespaces, None, SIZES)
+
+
+def run(sparql, graph, namespaces, AIDA, clusters=None):
+    """
+    Summary {cluster: {'size', 'digest', 'label', 'type', 'class'}} of the whole graph, or of the given clusters
+    only.
+    """
+    if clusters is None:
+        return collect(sparql, graph, namespaces, AIDA, SIZES + DESCRIPTIONS)
+    return collect(sparql, graph, namespaces, AIDA, DESCRIPTIONS, clusters)
+
+
+def describe(sparql, graph, namespaces, AIDA, data, clusters=None):
+    collect(sparql, graph, namespaces, AIDA, DESCRIPTIONS, clusters, data)
+
+
+def run_members(sparql, graph, file_path, namespaces):
+    """
+    Writes the member -> cluster index of a graph, prototypes left out.
+    """
+    open_clause, close_clause = graph_clauses(graph)
+
+    query = """
+    SELECT ?member ?cluster
+    WHERE {
+        %s
+            ?membership aida:cluster ?cluster ;
+                        aida:clusterMember ?member .
+            MINUS {?cluster aida:prototype ?member}
+        %s
+    } """ % (open_clause, close_clause)
 
-    pickle.dump(data, open(file_path, 'wb'))
+    members = {}
+    for member, cluster in sparql.query_stream(query, namespaces):
+        members[str(member)] = str(cluster)
 
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(members, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,204 @@
+from rdflib import Literal
+from rdflib.namespace import Namespace, SKOS
+import threading
+import sqlite3
+import json
+import time
+import os
+import setting
+import store
+import keyfile
+
+WDT = Namespace('http://www.wikidata.org/prop/direct/')
+namespaces = {
+    'wdt': WDT,
+    'skos': SKOS,
+}
+GEONAMES = 'P1566'
+FREEBASE = 'P646'
+
+
+def freebase_mid(fbid):
+    # 'LDC2015E42:m.0abc' -> '/m/0abc'
+    return '/' + fbid[fbid.find(':')+1:].replace('.', '/')
+
+
+def geonames_id(target):
+    # 'LDC2019E43:2950159' -> '2950159'
+    return target[target.find(':')+1:]
+
+
+class ResolverCache:
+    """
+    Wikidata lookups by (property, id) kept in memory and in a sqlite file. Ids without an entity
+    are remembered as well, for a shorter time.
+    """
+    def __init__(self, file_path, ttl, negative_ttl):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.__memory = {}  # (property, id) to (expires, value)
+        self.__lock = threading.Lock()
+        self.__db = None
+        if file_path:
+            directory = os.path.dirname(file_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.__db = sqlite3.connect(file_path, check_same_thread=False)
+            self.__db.execute('CREATE TABLE IF NOT EXISTS lookups '
+                              '(property TEXT, id TEXT, expires REAL, value TEXT, PRIMARY KEY (property, id))')
+            self.__db.commit()
+
+    def get_many(self, property_, ids):
+        """
+        Returns ({id: value} of the cached ids, with None for known misses, [ids not cached]).
+        """
+        now = time.time()
+        found = {}
+        missing = []
+        with self.__lock:
+            for id_ in ids:
+                entry = self.__memory.get((property_, id_))
+                if entry is None and self.__db:
+                    row = self.__db.execute('SELECT expires, value FROM lookups WHERE property = ? AND id = ?',
+                                            (property_, id_)).fetchone()
+                    if row:
+                        entry = (row[0], json.loads(row[1]) if row[1] else None)
+                        self.__memory[(property_, id_)] = entry
+                if entry and entry[0] > now:
+                    found[id_] = entry[1]
+                else:
+                    missing.append(id_)
+        return found, missing
+
+    def put_many(self, property_, values):
+        now = time.time()
+        rows = []
+        with self.__lock:
+            for id_, value in values.items():
+                expires = now + (self.ttl if value is not None else self.negative_ttl)
+                self.__memory[(property_, id_)] = (expires, value)
+                rows.append((property_, id_, expires, json.dumps(value) if value is not None else None))
+            if self.__db:
+                self.__db.executemany('INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?)', rows)
+                self.__db.commit()
+
+
+class WikidataResolver:
+    """
+    Resolves all GeoNames or freebase ids needed by a page, first from the local tables imported with
+    qnode_table.py, then from the cache and finally, if `network` is set, with one VALUES query per
+    property against the endpoint.
+    """
+    def __init__(self, sparql, cache, batch_size=200, tables=None, network=True):
+        self.sparql = sparql
+        self.cache = cache
+        self.batch_size = batch_size
+        self.tables = tables or {}  # property to key file path
+        self.network = network
+        self.__opened = {}  # property to (mtime, KeyFile)
+        self.__lock = threading.Lock()
+
+    def _table(self, property_):
+        # called with the lock held
+        path = self.tables.get(property_)
+        if not path or not os.path.isfile(path):
+            return None
+        mtime = os.path.getmtime(path)
+        opened = self.__opened.get(property_)
+        if opened is None or opened[0] != mtime:
+            # a re-imported table replaces the file, the mapping of the old one is released
+            self.__opened[property_] = (mtime, keyfile.KeyFile(path))
+            if opened:
+                opened[1].close()
+            opened = self.__opened[property_]
+        return opened[1]
+
+    def lookup(self, property_, ids):
+        """
+        {id: value} of the ids found in the local table of `property_`.
+        """
+        found = {}
+        # lookups hold the lock so that a table is never closed while it is read
+        with self.__lock:
+            table = self._table(property_)
+            if table:
+                for id_ in ids:
+                    value = table.get(id_)
+                    if value:
+                        found[id_] = json.loads(value)
+        return found
+
+    def _resolve(self, property_, ids, fetch):
+        ids = list(dict.fromkeys(ids))
+        found = self.lookup(property_, ids)
+        cached, missing = self.cache.get_many(property_, [id_ for id_ in ids if id_ not in found])
+        found.update(cached)
+        if not self.network:
+            missing = []
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i+self.batch_size]
+            fetched = dict.fromkeys(batch)
+            fetched.update(fetch(batch))
+            self.cache.put_many(property_, fetched)
+            found.update(fetched)
+        return {id_: found[id_] for id_ in ids if found.get(id_)}
+
+    def geonames(self, ids):
+        """
+        {GeoNames id: {'qnode', 'url', 'label'}} for the ids that have a Wikidata entity.
+        """
+        return self._resolve(GEONAMES, ids, self._fetch_geonames)
+
+    def freebase(self, mids):
+        """
+        {freebase mid: {'qid', 'url', 'label', 'aliases'}} for the mids that have a Wikidata entity.
+        """
+        return self._resolve(FREEBASE, mids, self._fetch_freebase)
+
+    def _fetch_geonames(self, ids):
+        query = '''
+SELECT ?target ?qnode ?qnodeLabel
+WHERE
+{
+    VALUES ?target { %s }
+    ?qnode wdt:P1566 ?target .
+    SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
+} ''' % ' '.join(Literal(id_).n3() for id_ in ids)
+        result = {}
+        for target, qnode, label in self.sparql.query(query, namespaces):
+            url = str(qnode)
+            result.setdefault(str(target), {
+                'qnode': url[url.rfind('/')+1:],
+                'url': url,
+                'label': str(label),
+            })
+        return result
+
+    def _fetch_freebase(self, mids):
+        query = """
+SELECT ?freebase ?qid ?label (GROUP_CONCAT(DISTINCT ?alias; separator=", ") AS ?aliases)
+WHERE {
+    VALUES ?freebase { %s }
+    ?qid wdt:P646 ?freebase .
+    ?qid rdfs:label ?label filter (lang(?label) = "en") .
+    OPTIONAL { ?qid skos:altLabel ?alias filter (lang(?alias) = "en") }
+}
+GROUP BY ?freebase ?qid ?label """ % ' '.join(Literal(mid).n3() for mid in mids)
+        result = {}
+        for freebase, qid, label, aliases in self.sparql.query(query, namespaces):
+            url = str(qid)
+            result.setdefault(str(freebase), {
+                'qid': url.rsplit('/', 1)[1],
+                'url': url,
+                'label': str(label),
+                'aliases': str(aliases) if aliases else '',
+            })
+        return result
+
+
+resolver = WikidataResolver(store.get_endpoint_store(setting.wikidata_endpoint),
+                            ResolverCache(setting.wikidata_cache, setting.wikidata_cache_ttl,
+                                          setting.wikidata_negative_ttl),
+                            setting.wikidata_batch_size,
+                            {GEONAMES: setting.geonames_table, FREEBASE: setting.freebase_table},
+                            setting.wikidata_network_fallback)